@@ -0,0 +1,290 @@
+"""Local stand-in for the Supervisely API that serves one project from fixture files.
+
+    python -m benchmarks.fake_api generate --fixtures fixtures --images 200
+    python -m benchmarks.fake_api serve --fixtures fixtures --port 8001 --latency 0.02
+
+Only the API methods the render app calls are implemented: project, dataset and image infos, project
+meta, annotation JSON (single and bulk), image bytes and resized previews. Every API call waits
+`latency` seconds (plus up to `jitter`) before answering, like a remote instance would.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+
+import cv2
+import numpy as np
+import uvicorn
+from fastapi import FastAPI, Request, Response
+from fastapi.responses import JSONResponse
+
+from supervisely.api.annotation_api import AnnotationApi
+from supervisely.api.dataset_api import DatasetApi
+from supervisely.api.image_api import ImageApi
+from supervisely.api.project_api import ProjectApi
+
+PROJECT_ID = 1
+DATASET_ID = 10
+FIRST_IMAGE_ID = 1000
+UPDATED_AT = "2024-01-01T00:00:00.000Z"
+SIZES = [(720, 1280), (1080, 1920), (2160, 3840)]
+# alpha masks are downloaded by the SDK through a separate figures API that is not emulated
+KINDS = ("polygon", "rectangle", "oriented_bbox", "bitmap", "graph", "cuboid_2d", "point", "polyline")
+
+
+def _info(api_class, values: dict) -> dict:
+    """Info JSON with every field the SDK reads, fields missing in values are null."""
+    info = {}
+    for field in api_class.info_sequence():
+        if isinstance(field, str):
+            info[field] = values.get(field)
+        else:
+            path, _ = field
+            info[path[0]] = values.get(path[0])
+    return info
+
+
+def _image_bytes(height: int, width: int, seed: int) -> bytes:
+    rng = np.random.default_rng(seed)
+    gradient = np.linspace(0, 255, width, dtype=np.float32)[None, :, None]
+    image = np.broadcast_to(gradient, (height, width, 3)) * rng.uniform(0.3, 1, 3)
+    image = image + rng.normal(0, 12, (height, width, 3))
+    success, buffer = cv2.imencode(".jpg", np.clip(image, 0, 255).astype(np.uint8))
+    return buffer.tobytes()
+
+
+def generate(fixtures: str, images: int, max_labels: int, seed: int = 0):
+    from benchmarks.synthetic import make_annotation, to_json
+
+    rng = random.Random(seed)
+    os.makedirs(os.path.join(fixtures, "images"), exist_ok=True)
+    os.makedirs(os.path.join(fixtures, "annotations"), exist_ok=True)
+    json_meta = None
+    for index in range(images):
+        image_id = FIRST_IMAGE_ID + index
+        height, width = rng.choice(SIZES)
+        labels = rng.randint(1, max_labels)
+        ann, meta = make_annotation(height, width, labels, kinds=KINDS, seed=image_id)
+        jann, json_meta = to_json(ann, meta)
+        for obj in jann["objects"]:
+            obj["id"] = image_id * 1000 + obj["id"]
+        with open(os.path.join(fixtures, "annotations", f"{image_id}.json"), "w") as file:
+            json.dump(jann, file)
+        with open(os.path.join(fixtures, "images", f"{image_id}.jpg"), "wb") as file:
+            file.write(_image_bytes(height, width, image_id))
+    with open(os.path.join(fixtures, "meta.json"), "w") as file:
+        json.dump(json_meta, file)
+    print(f"Generated {images} images in {fixtures}")
+
+
+class Fixtures:
+    def __init__(self, path: str):
+        self.path = path
+        with open(os.path.join(path, "meta.json")) as file:
+            self.meta = json.load(file)
+        self.annotations = {}
+        for name in os.listdir(os.path.join(path, "annotations")):
+            with open(os.path.join(path, "annotations", name)) as file:
+                self.annotations[int(name.split(".")[0])] = json.load(file)
+        self.image_ids = sorted(self.annotations)
+        self.project = _info(
+            ProjectApi,
+            {
+                "id": PROJECT_ID,
+                "name": "Load test",
+                "workspaceId": 1,
+                "teamId": 1,
+                "imagesCount": len(self.image_ids),
+                "itemsCount": len(self.image_ids),
+                "datasetsCount": 1,
+                "type": "images",
+                "createdAt": UPDATED_AT,
+                "updatedAt": UPDATED_AT,
+            },
+        )
+        self.dataset = _info(
+            DatasetApi,
+            {
+                "id": DATASET_ID,
+                "name": "ds",
+                "projectId": PROJECT_ID,
+                "imagesCount": len(self.image_ids),
+                "itemsCount": len(self.image_ids),
+                "workspaceId": 1,
+                "teamId": 1,
+                "createdAt": UPDATED_AT,
+                "updatedAt": UPDATED_AT,
+            },
+        )
+
+    def image(self, image_id: int, base_url: str) -> dict:
+        size = self.annotations[image_id]["size"]
+        return _info(
+            ImageApi,
+            {
+                "id": image_id,
+                "name": f"{image_id}.jpg",
+                "mime": "image/jpeg",
+                "ext": "jpg",
+                "size": os.path.getsize(self._image_path(image_id)),
+                "width": size["width"],
+                "height": size["height"],
+                "labelsCount": len(self.annotations[image_id]["objects"]),
+                "datasetId": DATASET_ID,
+                "projectId": PROJECT_ID,
+                "createdAt": UPDATED_AT,
+                "updatedAt": UPDATED_AT,
+                "meta": {},
+                "tags": [],
+                "fullStorageUrl": f"{base_url}/storage/{image_id}.jpg",
+            },
+        )
+
+    def annotation(self, image_id: int) -> dict:
+        return _info(
+            AnnotationApi,
+            {
+                "imageId": image_id,
+                "imageName": f"{image_id}.jpg",
+                "annotation": self.annotations[image_id],
+                "createdAt": UPDATED_AT,
+                "updatedAt": UPDATED_AT,
+                "datasetId": DATASET_ID,
+            },
+        )
+
+    def image_bytes(self, image_id: int) -> bytes:
+        with open(self._image_path(image_id), "rb") as file:
+            return file.read()
+
+    def _image_path(self, image_id: int) -> str:
+        return os.path.join(self.path, "images", f"{image_id}.jpg")
+
+
+def _page(entities: list) -> dict:
+    return {"total": len(entities), "perPage": max(len(entities), 1), "pagesCount": 1, "entities": entities}
+
+
+def _filter_ids(ids: list, filters: list) -> list:
+    for condition in filters or []:
+        if condition.get("field") != "id":
+            continue
+        operator, value = condition.get("operator"), condition.get("value")
+        if operator == "in":
+            ids = [i for i in ids if i in set(value)]
+        elif operator == ">":
+            ids = [i for i in ids if i > value]
+        elif operator == "=":
+            ids = [i for i in ids if i == value]
+    return ids
+
+
+def create_app(fixtures: Fixtures, latency: float, jitter: float) -> FastAPI:
+    app = FastAPI()
+    calls = {}
+
+    async def _wait():
+        delay = latency + random.uniform(0, jitter)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def _not_found(what):
+        return JSONResponse({"error": f"{what} not found"}, status_code=404)
+
+    @app.post("/public/api/v3/{method}")
+    async def api_method(method: str, request: Request):
+        calls[method] = calls.get(method, 0) + 1
+        data = json.loads(await request.body() or b"{}")
+        base_url = str(request.base_url).rstrip("/")
+        await _wait()
+
+        if method == "projects.info":
+            return fixtures.project if data.get("id") == PROJECT_ID else _not_found("Project")
+        if method == "projects.meta":
+            return fixtures.meta if data.get("id") == PROJECT_ID else _not_found("Project")
+        if method == "projects.list":
+            return _page([fixtures.project])
+        if method == "datasets.info":
+            return fixtures.dataset if data.get("id") == DATASET_ID else _not_found("Dataset")
+        if method == "datasets.list":
+            return _page([fixtures.dataset])
+        if method == "images.info":
+            if data.get("id") not in fixtures.annotations:
+                return _not_found("Image")
+            return fixtures.image(data["id"], base_url)
+        if method == "images.list":
+            ids = _filter_ids(fixtures.image_ids, data.get("filter"))
+            if data.get("sort_order") == "desc":
+                ids = ids[::-1]
+            if data.get("limit") is not None:
+                ids = ids[: data["limit"]]
+            return _page([fixtures.image(i, base_url) for i in ids])
+        if method == "annotations.info":
+            if data.get("imageId") not in fixtures.annotations:
+                return _not_found("Image")
+            return fixtures.annotation(data["imageId"])
+        if method == "annotations.bulk.info":
+            ids = [i for i in data.get("imageIds", []) if i in fixtures.annotations]
+            return [fixtures.annotation(i) for i in ids]
+        if method == "images.download":
+            if data.get("id") not in fixtures.annotations:
+                return _not_found("Image")
+            return Response(fixtures.image_bytes(data["id"]), media_type="image/jpeg")
+        return JSONResponse({"error": f"Method {method} is not emulated"}, status_code=404)
+
+    @app.get("/storage/{image_id}.jpg")
+    async def original(image_id: int):
+        await _wait()
+        return Response(fixtures.image_bytes(image_id), media_type="image/jpeg")
+
+    @app.get("/previews/{spec:path}")
+    async def preview(spec: str):
+        # previews/q/ext:jpeg/resize:force:<width>:<height>:0/q:<quality>/plain/storage/<id>.jpg
+        await _wait()
+        match = re.search(r"resize:\w+:(\d+):(\d+):\d+/q:(\d+)/plain/storage/(\d+)\.jpg", spec)
+        if match is None:
+            return _not_found("Preview")
+        width, height, quality, image_id = map(int, match.groups())
+        buffer = np.frombuffer(fixtures.image_bytes(image_id), dtype=np.uint8)
+        image = cv2.imdecode(buffer, cv2.IMREAD_COLOR)
+        if width > 0 and height > 0:
+            image = cv2.resize(image, (width, height), interpolation=cv2.INTER_AREA)
+        _, encoded = cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, quality])
+        return Response(encoded.tobytes(), media_type="image/jpeg")
+
+    @app.get("/calls")
+    def get_calls():
+        return calls
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+    generate_parser = commands.add_parser("generate", help="create fixture files")
+    generate_parser.add_argument("--fixtures", default="fixtures")
+    generate_parser.add_argument("--images", type=int, default=200)
+    generate_parser.add_argument("--max-labels", type=int, default=100)
+    serve_parser = commands.add_parser("serve", help="serve the fixtures")
+    serve_parser.add_argument("--fixtures", default="fixtures")
+    serve_parser.add_argument("--host", default="127.0.0.1")
+    serve_parser.add_argument("--port", type=int, default=8001)
+    serve_parser.add_argument("--latency", type=float, default=0.02, help="seconds per API call")
+    serve_parser.add_argument("--jitter", type=float, default=0.01, help="random extra latency")
+    args = parser.parse_args()
+
+    if args.command == "generate":
+        generate(args.fixtures, args.images, args.max_labels)
+    else:
+        app = create_app(Fixtures(args.fixtures), args.latency, args.jitter)
+        uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
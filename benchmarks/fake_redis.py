@@ -0,0 +1,154 @@
+"""Local stand-in for a Redis server to test the shared cache without one.
+
+    python -m benchmarks.fake_redis --port 6379 --max-memory-mb 512
+    SHARED_CACHE_URLS=redis://127.0.0.1:6379 uvicorn src.main:app
+
+Speaks the Redis protocol for the commands the app uses (GET, SET with EX/PX, EXISTS, DEL, PING,
+AUTH, SELECT) plus DBSIZE and FLUSHALL. Values live in memory in one database, the least recently
+used ones are evicted above `max-memory-mb` like with `maxmemory-policy allkeys-lru`.
+"""
+
+import argparse
+import asyncio
+import time
+from collections import OrderedDict
+
+
+class Store:
+    def __init__(self, max_memory: int):
+        self.max_memory = max_memory
+        self.size = 0
+        self._values = OrderedDict()  # key -> (value, expires or None)
+
+    def get(self, key: bytes):
+        entry = self._values.get(key)
+        if entry is None:
+            return None
+        if entry[1] is not None and entry[1] < time.monotonic():
+            self.delete(key)
+            return None
+        self._values.move_to_end(key)
+        return entry[0]
+
+    def set(self, key: bytes, value: bytes, ttl: float = None):
+        self.delete(key)
+        expires = None if ttl is None else time.monotonic() + ttl
+        self._values[key] = (value, expires)
+        self.size += len(key) + len(value)
+        while self.size > self.max_memory and len(self._values) > 1:
+            self.delete(next(iter(self._values)))
+
+    def delete(self, key: bytes) -> int:
+        entry = self._values.pop(key, None)
+        if entry is None:
+            return 0
+        self.size -= len(key) + len(entry[0])
+        return 1
+
+    def clear(self):
+        self._values.clear()
+        self.size = 0
+
+    def __len__(self):
+        return len(self._values)
+
+
+def _encode(reply) -> bytes:
+    if reply is None:
+        return b"$-1\r\n"
+    if isinstance(reply, int):
+        return b":%d\r\n" % reply
+    if isinstance(reply, str):
+        return f"+{reply}\r\n".encode("utf-8")
+    if isinstance(reply, Exception):
+        return f"-ERR {reply}\r\n".encode("utf-8")
+    return b"$%d\r\n%s\r\n" % (len(reply), reply)
+
+
+def execute(store: Store, command: list):
+    name, args = command[0].upper(), command[1:]
+    if name == b"GET":
+        return store.get(args[0])
+    if name == b"SET":
+        ttl = None
+        options = [arg.upper() for arg in args[2:]]
+        if b"EX" in options:
+            ttl = float(options[options.index(b"EX") + 1])
+        elif b"PX" in options:
+            ttl = float(options[options.index(b"PX") + 1]) / 1000
+        if b"NX" in options and store.get(args[0]) is not None:
+            return None
+        store.set(args[0], args[1], ttl)
+        return "OK"
+    if name == b"EXISTS":
+        return sum(store.get(key) is not None for key in args)
+    if name == b"DEL":
+        return sum(store.delete(key) for key in args)
+    if name == b"PING":
+        return "PONG"
+    if name in (b"AUTH", b"SELECT"):
+        return "OK"
+    if name == b"DBSIZE":
+        return len(store)
+    if name == b"FLUSHALL":
+        store.clear()
+        return "OK"
+    return ValueError(f"unknown command '{name.decode('utf-8', 'replace')}'")
+
+
+async def _read_command(reader: asyncio.StreamReader) -> list:
+    line = await reader.readline()
+    if not line:
+        return None
+    if not line.startswith(b"*"):
+        # inline command, e.g. from telnet
+        return line.split()
+    command = []
+    for _ in range(int(line[1:])):
+        length = int((await reader.readline())[1:])
+        command.append((await reader.readexactly(length + 2))[:-2])
+    return command
+
+
+def create_handler(store: Store):
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                command = await _read_command(reader)
+                if command is None:
+                    break
+                if len(command) == 0:
+                    continue
+                try:
+                    reply = execute(store, command)
+                except (IndexError, ValueError) as e:
+                    reply = ValueError(f"wrong arguments: {e}")
+                writer.write(_encode(reply))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    return handle
+
+
+async def serve(host: str, port: int, max_memory: int):
+    server = await asyncio.start_server(create_handler(Store(max_memory)), host, port)
+    async with server:
+        await server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=6379)
+    parser.add_argument("--max-memory-mb", type=int, default=512, help="LRU eviction above")
+    args = parser.parse_args()
+    asyncio.run(serve(args.host, args.port, args.max_memory_mb * 1024 * 1024))
+
+
+if __name__ == "__main__":
+    main()
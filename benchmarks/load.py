@@ -0,0 +1,329 @@
+"""End-to-end load test of the render server against the local fake Supervisely API.
+
+    python -m benchmarks.fake_api generate --fixtures fixtures --images 200
+    python -m benchmarks.load --fixtures fixtures --concurrency 16 --requests 2000 --output load.json
+
+Starts benchmarks.fake_api and `uvicorn src.main:app` pointed at it (with an empty app data
+directory, so the first request for every image is a cold render), sends `requests` requests to
+/renders and /render-on-image from `concurrency` clients and reports latency percentiles, status
+codes, throughput, render cache hits and the memory of the server process tree. No network access
+is needed. Pass --app-url to load an already running server instead.
+
+With --replicas N the app is started N times and every request goes to a random replica, like
+from a load balancer. --shared-cache redis gives every replica a benchmarks.fake_redis node of the
+shared cache, --shared-cache directory one shared directory, compare the render cache hits with
+--shared-cache none.
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter, defaultdict
+
+import httpx
+import numpy as np
+import psutil
+
+from benchmarks.fake_api import PROJECT_ID, Fixtures
+
+ENDPOINTS = ("renders", "render-on-image")
+SHARED_CACHES = ("none", "redis", "directory")
+
+
+def _wait_ready(url: str, process: subprocess.Popen, timeout: float = 120):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"{process.args} exited with code {process.returncode}")
+        try:
+            httpx.get(url, timeout=1)
+            return
+        except httpx.TransportError:
+            time.sleep(0.2)
+    raise TimeoutError(f"{url} is not ready after {timeout} seconds")
+
+
+def _start(args: list, env: dict, log_path: str) -> subprocess.Popen:
+    with open(log_path, "wb") as log:
+        return subprocess.Popen(
+            [sys.executable, *args], env=env, stdout=log, stderr=subprocess.STDOUT
+        )
+
+
+def _stop(process: subprocess.Popen):
+    if process.poll() is None:
+        process.terminate()
+        try:
+            process.wait(10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+class MemorySampler(threading.Thread):
+    """Samples the RSS of processes and their children (render pool workers) every `interval` s."""
+
+    def __init__(self, pids: list, interval: float = 0.25):
+        super().__init__(daemon=True)
+        self.processes = [psutil.Process(pid) for pid in pids]
+        self.interval = interval
+        self.peak = 0
+        self.last = 0
+        self._stopped = threading.Event()
+
+    def sample(self) -> int:
+        total = 0
+        processes = []
+        for parent in self.processes:
+            try:
+                processes += [parent, *parent.children(recursive=True)]
+            except psutil.Error:
+                pass
+        for process in processes:
+            try:
+                total += process.memory_info().rss
+            except psutil.Error:
+                pass
+        self.last = total
+        self.peak = max(self.peak, total)
+        return total
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            self.sample()
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+        self.sample()
+
+
+def _requests(image_ids: list, endpoints: list, count: int, output_format: str):
+    """(endpoint, url, params) for every request, images round robin, endpoints alternating."""
+    pairs = itertools.cycle(itertools.product(image_ids, endpoints))
+    for _ in range(count):
+        image_id, endpoint = next(pairs)
+        params = {"image_id": image_id}
+        if endpoint == "renders":
+            params["project_id"] = PROJECT_ID
+        if output_format is not None:
+            params["format"] = output_format
+        yield endpoint, f"/{endpoint}", params
+
+
+async def _drive(app_urls: list, requests: list, concurrency: int, timeout: float) -> dict:
+    """Sends every request to a random app, like a load balancer without session affinity."""
+    results = defaultdict(lambda: {"latencies": [], "statuses": Counter(), "bytes": 0})
+    rng = random.Random(0)
+    queue = iter([(rng.randrange(len(app_urls)), request) for request in requests])
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+    async def _client(clients: list):
+        for index, (endpoint, path, params) in queue:
+            client = clients[index]
+            result = results[endpoint]
+            start = time.perf_counter()
+            try:
+                response = await client.get(path, params=params)
+                status = str(response.status_code)
+                result["bytes"] += len(response.content)
+            except httpx.HTTPError as e:
+                status = type(e).__name__
+            result["latencies"].append(time.perf_counter() - start)
+            result["statuses"][status] += 1
+
+    clients = [
+        httpx.AsyncClient(base_url=app_url, timeout=timeout, limits=limits) for app_url in app_urls
+    ]
+    try:
+        await asyncio.gather(*[_client(clients) for _ in range(concurrency)])
+    finally:
+        for client in clients:
+            await client.aclose()
+    return results
+
+
+def cache_stats(app_urls: list) -> dict:
+    """render_cache_requests_total of the apps summed by result."""
+    stats = Counter()
+    for app_url in app_urls:
+        try:
+            text = httpx.get(f"{app_url}/metrics", timeout=10).text
+        except httpx.HTTPError:
+            continue
+        for line in text.splitlines():
+            if line.startswith("render_cache_requests_total{"):
+                labels, value = line.rsplit(" ", 1)
+                stats[labels.split('result="')[1].split('"')[0]] += int(float(value))
+    return dict(stats)
+
+
+def environment() -> dict:
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "HEAD"], text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "commit": commit,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+    }
+
+
+def summarize(results: dict, elapsed: float) -> dict:
+    summary = {}
+    for endpoint, result in sorted(results.items()):
+        latencies = np.array(result["latencies"])
+        summary[endpoint] = {
+            "requests": len(latencies),
+            "statuses": dict(result["statuses"]),
+            "p50_s": float(np.percentile(latencies, 50)),
+            "p95_s": float(np.percentile(latencies, 95)),
+            "p99_s": float(np.percentile(latencies, 99)),
+            "max_s": float(latencies.max()),
+            "throughput_rps": len(latencies) / elapsed,
+            "response_bytes": result["bytes"],
+        }
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter
+    )
+    parser.add_argument("--fixtures", default="fixtures", help="benchmarks.fake_api fixtures")
+    parser.add_argument("--app-url", default=None, help="load a running server instead")
+    parser.add_argument("--concurrency", type=int, default=16, help="simultaneous clients")
+    parser.add_argument("--requests", type=int, default=1000, help="total requests to send")
+    parser.add_argument("--endpoints", nargs="+", default=list(ENDPOINTS), choices=ENDPOINTS)
+    parser.add_argument("--format", dest="output_format", default=None, help="output format")
+    parser.add_argument("--latency", type=float, default=0.02, help="fake API seconds per call")
+    parser.add_argument("--timeout", type=float, default=120, help="request timeout in seconds")
+    parser.add_argument("--api-port", type=int, default=7999)
+    parser.add_argument("--app-port", type=int, default=8000)
+    parser.add_argument("--replicas", type=int, default=1, help="app processes to start")
+    parser.add_argument("--shared-cache", default="none", choices=SHARED_CACHES)
+    parser.add_argument("--redis-port", type=int, default=6390, help="first fake Redis node port")
+    parser.add_argument("--output", default=None, help="results JSON path")
+    args = parser.parse_args()
+
+    image_ids = Fixtures(args.fixtures).image_ids
+    requests = list(_requests(image_ids, args.endpoints, args.requests, args.output_format))
+    processes, data_dir = [], None
+    try:
+        app_urls, sampler = [args.app_url], None
+        if args.app_url is None:
+            data_dir = tempfile.mkdtemp(prefix="render-load-")
+            api_url = f"http://127.0.0.1:{args.api_port}"
+            app_urls = [f"http://127.0.0.1:{args.app_port + i}" for i in range(args.replicas)]
+            env = dict(os.environ)
+            api = _start(
+                ["-m", "benchmarks.fake_api", "serve", "--fixtures", args.fixtures,
+                 "--port", str(args.api_port), "--latency", str(args.latency)],
+                env,
+                os.path.join(data_dir, "fake_api.log"),
+            )
+            processes.append(api)
+            _wait_ready(f"{api_url}/calls", api)
+            shared_urls = []
+            if args.shared_cache == "redis":
+                for i in range(args.replicas):
+                    port = args.redis_port + i
+                    processes.append(
+                        _start(
+                            ["-m", "benchmarks.fake_redis", "--port", str(port)],
+                            env,
+                            os.path.join(data_dir, f"redis_{port}.log"),
+                        )
+                    )
+                    shared_urls.append(f"redis://127.0.0.1:{port}")
+            elif args.shared_cache == "directory":
+                shared_urls.append(os.path.join(data_dir, "shared"))
+            env.update(
+                SERVER_ADDRESS=api_url,
+                API_TOKEN="0" * 128,
+                TEAM_ID="1",
+                WORKSPACE_ID="1",
+                ENV="development",
+                SHARED_CACHE_URLS=",".join(shared_urls),
+            )
+            apps = []
+            for i in range(args.replicas):
+                port = str(args.app_port + i)
+                app = _start(
+                    ["-m", "uvicorn", "src.main:app", "--port", port, "--log-level", "warning"],
+                    {**env, "SLY_APP_DATA_DIR": os.path.join(data_dir, f"app_{i}")},
+                    os.path.join(data_dir, f"app_{i}.log"),
+                )
+                processes.append(app)
+                apps.append(app)
+            for app, app_url in zip(apps, app_urls):
+                _wait_ready(f"{app_url}/metrics", app)
+            sampler = MemorySampler([app.pid for app in apps])
+            sampler.sample()
+            idle_rss = sampler.last
+            sampler.start()
+
+        start = time.perf_counter()
+        results = asyncio.run(_drive(app_urls, requests, args.concurrency, args.timeout))
+        elapsed = time.perf_counter() - start
+        render_cache = cache_stats(app_urls)
+    finally:
+        if sampler is not None:
+            sampler.stop()
+        for process in reversed(processes):
+            _stop(process)
+        if data_dir is not None:
+            shutil.rmtree(data_dir, ignore_errors=True)
+
+    summary = summarize(results, elapsed)
+    print(f"\n{'endpoint':<18} {'requests':>8} {'p50':>9} {'p95':>9} {'p99':>9} {'rps':>8}  statuses")
+    for endpoint, s in summary.items():
+        print(
+            f"{endpoint:<18} {s['requests']:>8} {s['p50_s'] * 1000:>7.1f}ms {s['p95_s'] * 1000:>7.1f}ms "
+            f"{s['p99_s'] * 1000:>7.1f}ms {s['throughput_rps']:>8.1f}  {s['statuses']}"
+        )
+    print(f"\n{len(requests)} requests in {elapsed:.1f}s, {len(requests) / elapsed:.1f} requests/s")
+    lookups = sum(render_cache.values())
+    if lookups > 0:
+        hits = lookups - render_cache.get("miss", 0)
+        print(f"Render cache: {hits / lookups:.1%} hits of {lookups} lookups {render_cache}")
+    memory = None
+    if sampler is not None:
+        memory = {"idle_rss": idle_rss, "peak_rss": sampler.peak, "final_rss": sampler.last}
+        print(
+            f"Server RSS: idle {idle_rss / 2**20:.0f} MiB, peak {sampler.peak / 2**20:.0f} MiB, "
+            f"final {sampler.last / 2**20:.0f} MiB"
+        )
+
+    if args.output is not None:
+        config = {key: value for key, value in vars(args).items() if key != "output"}
+        with open(args.output, "w") as file:
+            json.dump(
+                {
+                    "environment": environment(),
+                    "config": config,
+                    "elapsed_s": elapsed,
+                    "memory": memory,
+                    "render_cache": render_cache,
+                    "results": summary,
+                },
+                file,
+                indent=4,
+            )
+        print(f"Results saved to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,176 @@
+"""Render path micro-benchmarks on synthetic annotations.
+
+    python -m benchmarks.run --output results.json
+    python -m benchmarks.run --output new.json --compare results.json --threshold 1.2
+
+With --compare the run exits with code 1 if the median time of any benchmark grew more than
+`threshold` times compared to the baseline results.
+"""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Callable, Dict
+
+# the render modules create an API client and read the app environment on import, nothing is
+# requested from the instance while benchmarking
+os.environ.setdefault("SERVER_ADDRESS", "http://localhost")
+os.environ.setdefault("API_TOKEN", "0" * 128)
+os.environ.setdefault("TEAM_ID", "1")
+os.environ.setdefault("WORKSPACE_ID", "1")
+os.environ.setdefault("SLY_APP_DATA_DIR", os.path.join(tempfile.gettempdir(), "render-benchmarks"))
+os.environ.setdefault("ENV", "development")
+
+import cv2
+import numpy as np
+
+import src.encoders as encoders
+import src.utils as u
+import supervisely as sly
+from benchmarks.synthetic import make_annotation, to_json
+
+SIZES = {"hd": (720, 1280), "4k": (2160, 3840)}
+QUICK = {"sizes": ["hd"], "labels": [10, 100]}
+FULL = {"sizes": ["hd", "4k"], "labels": [10, 100, 1000]}
+
+
+def _render(ann: sly.Annotation, **kwargs):
+    return u.get_rgba_np(ann, 500, 0.5, 1, 0.2, 0.7, 0, 0, render_heatmap=True, **kwargs)
+
+
+def build_cases(config: dict) -> Dict[str, Callable]:
+    cases = {}
+    for size_name in config["sizes"]:
+        height, width = SIZES[size_name]
+        for labels in config["labels"]:
+            ann, _ = make_annotation(height, width, labels, seed=labels)
+            cases[f"get_rgba_np/{size_name}/{labels}"] = lambda ann=ann: _render(ann)
+
+            ann, _ = make_annotation(height, width, labels, tags_per_label=3, seed=labels)
+            image = np.random.default_rng(labels).integers(0, 256, (height, width, 3), np.uint8)
+            cases[f"get_rgba_np_on_image_tags/{size_name}/{labels}"] = (
+                lambda ann=ann, image=image: _render(
+                    ann, draw_tags=True, with_image=True, bitmap=image, skip_resize=True
+                )
+            )
+
+            ann, meta = make_annotation(height, width, labels * 10, seed=labels)
+            jann, _ = to_json(ann, meta)
+            for obj in jann["objects"][::10]:
+                obj["classTitle"] = "deleted class"
+            cases[f"repair_annotation/{size_name}/{labels * 10}"] = (
+                lambda jann=jann, meta=meta: u.parse_annotation(None, None, meta, jann)
+            )
+
+        dense, _ = make_annotation(
+            height, width, 5000, kinds=("polygon", "bitmap", "rectangle", "point"), label_size=24, seed=5
+        )
+        cases[f"get_rgba_np_dense/{size_name}/5000"] = lambda ann=dense: _render(ann, skip_resize=True)
+
+        heatmap, _ = make_annotation(
+            height, width, 1, kinds=("alpha_mask",), label_size=min(height, width)
+        )
+        geometry = heatmap.labels[0].geometry
+        cases[f"color_map/{size_name}"] = lambda geometry=geometry, size=(height, width): (
+            u.color_map(size, geometry.data, geometry.origin, 0.2)
+        )
+
+        ann, _ = make_annotation(height, width, 100, seed=1)
+        rgba, _, _ = _render(ann, skip_resize=True)
+        bgra = cv2.cvtColor(rgba, cv2.COLOR_RGBA2BGRA)
+        for output_format in ("png", "webp-lossless"):
+            cases[f"encode_{output_format}/{size_name}"] = lambda bgra=bgra, fmt=output_format: (
+                encoders.encode(bgra, fmt, {})
+            )
+    return cases
+
+
+def measure(func: Callable, repeat: int) -> dict:
+    func()  # warm up caches and lazy imports
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return {
+        "median_s": float(np.median(times)),
+        "min_s": min(times),
+        "mean_s": float(np.mean(times)),
+        "repeat": repeat,
+    }
+
+
+def environment() -> dict:
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "HEAD"], text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "commit": commit,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "numpy": np.__version__,
+        "opencv": cv2.__version__,
+        "supervisely": sly.__version__,
+    }
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> bool:
+    """Prints the median ratios against the baseline, returns False if any exceeds threshold."""
+    passed = True
+    print(f"\n{'benchmark':<48} {'baseline':>10} {'current':>10} {'ratio':>7}")
+    for name, current in results.items():
+        previous = baseline.get(name)
+        if previous is None:
+            print(f"{name:<48} {'-':>10} {current['median_s'] * 1000:>8.2f}ms {'new':>7}")
+            continue
+        ratio = current["median_s"] / previous["median_s"]
+        regressed = ratio > threshold
+        passed = passed and not regressed
+        print(
+            f"{name:<48} {previous['median_s'] * 1000:>8.2f}ms "
+            f"{current['median_s'] * 1000:>8.2f}ms {ratio:>6.2f}x{'  REGRESSION' if regressed else ''}"
+        )
+    return passed
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter
+    )
+    parser.add_argument("--output", default="benchmark_results.json", help="results JSON path")
+    parser.add_argument("--repeat", type=int, default=5, help="timed runs of every benchmark")
+    parser.add_argument("--full", action="store_true", help="add 4K frames and 1000 labels")
+    parser.add_argument("--filter", default=None, help="run only benchmarks containing this string")
+    parser.add_argument("--compare", default=None, help="baseline results to compare with")
+    parser.add_argument("--threshold", type=float, default=1.2, help="allowed median slowdown")
+    args = parser.parse_args()
+
+    cases = build_cases(FULL if args.full else QUICK)
+    results = {}
+    for name, func in cases.items():
+        if args.filter is not None and args.filter not in name:
+            continue
+        results[name] = measure(func, args.repeat)
+        print(f"{name:<48} {results[name]['median_s'] * 1000:>8.2f}ms")
+
+    with open(args.output, "w") as file:
+        json.dump({"environment": environment(), "results": results}, file, indent=4)
+    print(f"Results saved to {args.output}")
+
+    if args.compare is not None:
+        with open(args.compare) as file:
+            baseline = json.load(file)["results"]
+        if not compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
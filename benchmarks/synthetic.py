@@ -0,0 +1,139 @@
+"""Synthetic annotations for the render benchmarks, generated offline and deterministically."""
+
+from typing import Tuple
+
+import numpy as np
+
+import supervisely as sly
+from supervisely.geometry.cuboid_2d import CUBOID2D_VERTICES_NAMES, Cuboid2d, Cuboid2dTemplate
+from supervisely.geometry.graph import GraphNodes, KeypointsTemplate, Node
+
+KINDS = (
+    "polygon",
+    "rectangle",
+    "oriented_bbox",
+    "bitmap",
+    "alpha_mask",
+    "graph",
+    "cuboid_2d",
+    "point",
+    "polyline",
+)
+COLORS = [[255, 0, 0], [0, 255, 0], [10, 20, 200], [250, 128, 3], [0, 0, 255], [200, 0, 200]]
+KEYPOINTS = 17
+
+
+def _keypoints_template() -> KeypointsTemplate:
+    template = KeypointsTemplate()
+    for i in range(KEYPOINTS):
+        template.add_point(label=str(i), row=i, col=i)
+    for i in range(KEYPOINTS - 1):
+        template.add_edge(src=str(i), dst=str(i + 1))
+    return template
+
+
+def _geometry(kind: str, rng: np.random.Generator, height: int, width: int, label_size: int):
+    h = int(rng.integers(max(label_size // 4, 4), max(label_size, 5)))
+    w = int(rng.integers(max(label_size // 4, 4), max(label_size, 5)))
+    top = int(rng.integers(0, max(height - h, 1)))
+    left = int(rng.integers(0, max(width - w, 1)))
+    if kind == "polygon":
+        angles = np.sort(rng.uniform(0, 2 * np.pi, 24))
+        rows = top + h / 2 + np.sin(angles) * h / 2
+        cols = left + w / 2 + np.cos(angles) * w / 2
+        return sly.Polygon([sly.PointLocation(int(r), int(c)) for r, c in zip(rows, cols)])
+    if kind == "rectangle":
+        return sly.Rectangle(top, left, top + h - 1, left + w - 1)
+    if kind == "oriented_bbox":
+        angle = float(rng.uniform(0, 1))
+        return sly.OrientedBBox(top, left, top + h - 1, left + w - 1, angle=angle)
+    if kind == "bitmap":
+        yy, xx = np.ogrid[:h, :w]
+        mask = ((yy - h / 2) / (h / 2)) ** 2 + ((xx - w / 2) / (w / 2)) ** 2 <= 1
+        mask[h // 2, w // 2] = True
+        return sly.Bitmap(mask, origin=sly.PointLocation(top, left))
+    if kind == "alpha_mask":
+        yy, xx = np.ogrid[:h, :w]
+        distance = np.sqrt(((yy - h / 2) / (h / 2)) ** 2 + ((xx - w / 2) / (w / 2)) ** 2)
+        data = (np.clip(1 - distance, 0, 1) * 255).astype(np.uint8)
+        data[h // 2, w // 2] = 255
+        return sly.AlphaMask(data, origin=sly.PointLocation(top, left))
+    if kind == "graph":
+        rows = top + rng.integers(0, h, KEYPOINTS)
+        cols = left + rng.integers(0, w, KEYPOINTS)
+        nodes = {
+            str(i): Node(sly.PointLocation(int(row), int(col)))
+            for i, (row, col) in enumerate(zip(rows, cols))
+        }
+        return GraphNodes(nodes)
+    if kind == "cuboid_2d":
+        shift = max(min(h, w) // 4, 1)
+        corners = [(0, 0), (0, 1), (1, 1), (1, 0)]
+        points = [(top + r * (h - shift), left + c * (w - shift)) for r, c in corners]
+        points += [(row + shift, col + shift) for row, col in points]
+        nodes = {
+            name: Node(sly.PointLocation(int(row), int(col)))
+            for name, (row, col) in zip(CUBOID2D_VERTICES_NAMES, points)
+        }
+        return Cuboid2d(nodes)
+    if kind == "point":
+        return sly.Point(top, left)
+    if kind == "polyline":
+        rows = np.linspace(top, top + h - 1, 8) + rng.integers(-3, 4, 8)
+        cols = np.linspace(left, left + w - 1, 8)
+        return sly.Polyline([sly.PointLocation(int(r), int(c)) for r, c in zip(rows, cols)])
+    raise ValueError(f"Unknown label kind '{kind}'")
+
+
+def make_annotation(
+    height: int,
+    width: int,
+    labels: int,
+    kinds=KINDS,
+    tags_per_label: int = 0,
+    label_size: int = None,
+    seed: int = 0,
+) -> Tuple[sly.Annotation, sly.ProjectMeta]:
+    """Annotation with `labels` labels of the given kinds (round robin) and its project meta. Every
+    kind has its own class, classes and tag metas get IDs as they would in a real project."""
+    rng = np.random.default_rng(seed)
+    label_size = label_size or max(min(height, width) // 6, 8)
+    obj_classes = {}
+    for index, kind in enumerate(kinds):
+        color = COLORS[index % len(COLORS)]
+        if kind == "graph":
+            template = _keypoints_template()
+            obj_class = sly.ObjClass(kind, GraphNodes, color, template, sly_id=index + 1)
+        elif kind == "cuboid_2d":
+            template = Cuboid2dTemplate(color)
+            obj_class = sly.ObjClass(kind, Cuboid2d, color, template, sly_id=index + 1)
+        else:
+            geometry_type = type(_geometry(kind, rng, height, width, label_size))
+            obj_class = sly.ObjClass(kind, geometry_type, color, sly_id=index + 1)
+        obj_classes[kind] = obj_class
+    tag_metas = [
+        sly.TagMeta(f"tag_{i}", sly.TagValueType.ANY_STRING, sly_id=100 + i)
+        for i in range(tags_per_label)
+    ]
+    meta = sly.ProjectMeta(obj_classes=list(obj_classes.values()), tag_metas=tag_metas)
+
+    result = []
+    for index in range(labels):
+        kind = kinds[index % len(kinds)]
+        geometry = _geometry(kind, rng, height, width, label_size)
+        tags = [sly.Tag(tag_meta, value=f"value {index}") for tag_meta in tag_metas]
+        result.append(sly.Label(geometry, obj_classes[kind], tags=tags))
+    return sly.Annotation((height, width), labels=result), meta
+
+
+def to_json(ann: sly.Annotation, meta: sly.ProjectMeta) -> Tuple[dict, dict]:
+    """Annotation and project meta JSON with the class IDs the server would return."""
+    jann = ann.to_json()
+    class_ids = {obj_class.name: obj_class.sly_id for obj_class in meta.obj_classes}
+    for index, obj in enumerate(jann["objects"]):
+        obj["id"] = index + 1
+        obj["classId"] = class_ids[obj["classTitle"]]
+    json_meta = meta.to_json()
+    for cls in json_meta["classes"]:
+        cls["id"] = class_ids[cls["title"]]
+    return jann, json_meta
@@ -0,0 +1,90 @@
+import asyncio
+from collections import deque
+from contextlib import asynccontextmanager
+
+from fastapi import HTTPException
+
+import src.metrics as metrics
+
+
+class MemoryBudget:
+    """Admits renders while the sum of their estimated peak memory stays within `limit` bytes.
+
+    The rest wait in FIFO order, at most `queue_limit` of them for at most `timeout` seconds, and get
+    503 with Retry-After when the queue is full or the wait is over. A render estimated to need more
+    than the whole budget is admitted alone.
+    """
+
+    def __init__(
+        self, name: str, limit: int, queue_limit: int = 64, timeout: float = 30, retry_after: int = 5
+    ):
+        self.name = name
+        self.limit = limit
+        self.queue_limit = queue_limit
+        self.timeout = timeout
+        self.retry_after = retry_after
+        self.used = 0
+        self._waiters = deque()  # (cost, asyncio.Future)
+
+    @asynccontextmanager
+    async def admit(self, cost: int):
+        await self._acquire(cost)
+        try:
+            yield
+        finally:
+            self._release(cost)
+
+    def waiting(self) -> int:
+        return len(self._waiters)
+
+    def _fits(self, cost: int) -> bool:
+        return self.used == 0 or self.used + cost <= self.limit
+
+    async def _acquire(self, cost: int):
+        if len(self._waiters) == 0 and self._fits(cost):
+            self.used += cost
+            return
+        if len(self._waiters) >= self.queue_limit:
+            self._reject()
+        future = asyncio.get_running_loop().create_future()
+        waiter = (cost, future)
+        self._waiters.append(waiter)
+        try:
+            await asyncio.wait_for(future, self.timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if future.done() and not future.cancelled():
+                # admitted at the same moment the wait ended
+                if isinstance(e, asyncio.TimeoutError):
+                    return
+                self._release(cost)
+                raise
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+            self._wake()  # the next waiter may fit now that the head of the queue is gone
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            self._reject()
+
+    def _release(self, cost: int):
+        self.used -= cost
+        self._wake()
+
+    def _wake(self):
+        while len(self._waiters) > 0:
+            cost, future = self._waiters[0]
+            if future.done():
+                self._waiters.popleft()
+                continue
+            if not self._fits(cost):
+                break
+            self._waiters.popleft()
+            self.used += cost
+            future.set_result(None)
+
+    def _reject(self):
+        metrics.inc("admission_rejected_total", lane=self.name)
+        raise HTTPException(
+            status_code=503,
+            detail="The server is busy rendering, retry later",
+            headers={"Retry-After": str(self.retry_after)},
+        )
@@ -0,0 +1,347 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+import src.metrics as metrics
+import supervisely as sly
+from src.shared_cache import SharedCache
+
+
+def settings_hash(settings: dict) -> str:
+    dumped = json.dumps(settings, sort_keys=True, default=str)
+    return hashlib.sha1(dumped.encode("utf-8")).hexdigest()
+
+
+def render_key(
+    image_id: int,
+    updated_at: str,
+    project_updated_at: str,
+    figure_id: Optional[int],
+    settings: dict,
+    output_format: str = "png",
+    region: Optional[str] = None,
+) -> str:
+    # the project version is part of the key like of the ETag: renders depend on the project meta
+    raw = (
+        f"{image_id}:{updated_at}:{project_updated_at}:{figure_id}:"
+        f"{settings_hash(settings)}:{output_format}"
+    )
+    if region is not None:
+        raw += f":{region}"
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def etag(*parts) -> str:
+    raw = ":".join(str(part) for part in parts)
+    return '"' + hashlib.sha256(raw.encode("utf-8")).hexdigest()[:32] + '"'
+
+
+def etag_matches(if_none_match: Optional[str], current: str) -> bool:
+    if not if_none_match:
+        return False
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == "*" or candidate == current:
+            return True
+    return False
+
+
+class RenderCache:
+    """Two-level cache for encoded renders: in-memory LRU in front of a content-addressed
+    directory on disk. Both levels are bounded by total size in bytes and evict the least
+    recently used entries first. Local misses are looked up in the `shared` cache of all replicas,
+    if there is one, and new renders are stored there too."""
+
+    def __init__(
+        self,
+        cache_dir: str,
+        memory_limit: int,
+        disk_limit: int,
+        ext: str = ".bin",
+        shared: Optional[SharedCache] = None,
+    ):
+        self.cache_dir = cache_dir
+        self.memory_limit = memory_limit
+        self.disk_limit = disk_limit
+        self.ext = ext
+        self.shared = shared
+        self._lock = threading.Lock()
+        self._memory = OrderedDict()  # key -> bytes
+        self._memory_size = 0
+        self._disk = OrderedDict()  # key -> size in bytes
+        self._disk_size = 0
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self._load_disk_index()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], key + self.ext)
+
+    def _load_disk_index(self):
+        entries = []
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                if not name.endswith(self.ext):
+                    continue
+                stat = os.stat(os.path.join(root, name))
+                entries.append((stat.st_mtime, name[: -len(self.ext)], stat.st_size))
+        for _, key, size in sorted(entries):
+            self._disk[key] = size
+            self._disk_size += size
+        self._evict_disk()
+        sly.logger.info(f"Render cache: {len(self._disk)} entries ({self._disk_size} bytes) on disk")
+
+    def __contains__(self, key: str) -> bool:
+        with self._lock:
+            if key in self._memory or key in self._disk:
+                return True
+        return self.shared is not None and f"render:{key}" in self.shared
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            data = self._memory.get(key)
+            if data is not None:
+                self._memory.move_to_end(key)
+                metrics.inc("render_cache_requests_total", result="memory_hit")
+                return data
+            on_disk = key in self._disk
+            if on_disk:
+                self._disk.move_to_end(key)
+        if on_disk:
+            try:
+                with open(self._path(key), "rb") as file:
+                    data = file.read()
+            except FileNotFoundError:
+                with self._lock:
+                    size = self._disk.pop(key, None)
+                    if size is not None:
+                        self._disk_size -= size
+        if data is not None:
+            metrics.inc("render_cache_requests_total", result="disk_hit")
+            with self._lock:
+                self._put_memory(key, data)
+            return data
+        if self.shared is not None:
+            data = self.shared.get(f"render:{key}")
+            if data is not None:
+                metrics.inc("render_cache_requests_total", result="shared_hit")
+                self._put_local(key, data)
+                return data
+        metrics.inc("render_cache_requests_total", result="miss")
+        return None
+
+    def put(self, key: str, data: bytes):
+        self._put_local(key, data)
+        if self.shared is not None:
+            self.shared.put(f"render:{key}", data)
+
+    def _put_local(self, key: str, data: bytes):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as file:
+            file.write(data)
+        os.replace(tmp_path, path)
+        with self._lock:
+            self._put_memory(key, data)
+            size = self._disk.pop(key, None)
+            if size is not None:
+                self._disk_size -= size
+            self._disk[key] = len(data)
+            self._disk_size += len(data)
+            self._evict_disk()
+
+    def _put_memory(self, key: str, data: bytes):
+        if len(data) > self.memory_limit:
+            return
+        old = self._memory.pop(key, None)
+        if old is not None:
+            self._memory_size -= len(old)
+        self._memory[key] = data
+        self._memory_size += len(data)
+        while self._memory_size > self.memory_limit:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_size -= len(evicted)
+
+    def _evict_disk(self):
+        while self._disk_size > self.disk_limit and len(self._disk) > 0:
+            key, size = self._disk.popitem(last=False)
+            self._disk_size -= size
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
+
+
+def annotation_size(ann: sly.Annotation) -> int:
+    """Rough memory footprint of a parsed annotation: raster data plus a fixed cost per label."""
+    size = 0
+    for label in ann.labels:
+        size += 1024
+        data = getattr(label.geometry, "data", None)
+        if data is not None:
+            size += data.nbytes
+    return size
+
+
+class AnnotationCache:
+    """Parsed annotations in memory keyed by (image ID, image `updated_at`, project `updated_at`),
+    an LRU bounded by the estimated size of the annotations in bytes. Per-figure renders and tiles
+    of one image share one download and parse."""
+
+    def __init__(self, memory_limit: int):
+        self.memory_limit = memory_limit
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (annotation, size in bytes)
+        self._size = 0
+
+    def get(self, key) -> Optional[sly.Annotation]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                metrics.inc("annotation_cache_requests_total", result="miss")
+                return None
+            self._entries.move_to_end(key)
+        metrics.inc("annotation_cache_requests_total", result="hit")
+        return entry[0]
+
+    def put(self, key, ann: sly.Annotation):
+        size = annotation_size(ann)
+        if size > self.memory_limit:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._size -= old[1]
+            self._entries[key] = (ann, size)
+            self._size += size
+            while self._size > self.memory_limit:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self._size -= evicted
+
+
+class MetaCache:
+    """Parsed project metas keyed by project ID. Every entry remembers the project `updated_at` it was
+    fetched for, a lookup with a different version refetches the meta. Broken metas are stored
+    already repaired, so the repair runs once per version instead of once per request.
+
+    Metas are fetched lazily on first use, concurrent lookups of one project share the fetch. The
+    raw metas with their versions can be saved to `snapshot_path` and loaded back after a restart.
+    Versioned metas are looked up in the `shared` cache of all replicas before the fetch.
+    """
+
+    def __init__(
+        self, fetch, snapshot_path: Optional[str] = None, shared: Optional[SharedCache] = None
+    ):
+        self._fetch = fetch
+        self.snapshot_path = snapshot_path
+        self.shared = shared
+        self._lock = threading.Lock()
+        self._entries = {}  # project_id -> [version, json, parsed meta or None]
+        self._fetch_locks = {}  # project_id -> threading.Lock
+
+    def put(self, project_id: int, json_project_meta: dict, version: Optional[str] = None):
+        with self._lock:
+            self._entries[project_id] = [version, json_project_meta, None]
+
+    def invalidate(self, project_id: int):
+        with self._lock:
+            self._entries.pop(project_id, None)
+
+    def version(self, project_id: int) -> Optional[str]:
+        with self._lock:
+            entry = self._entries.get(project_id)
+        return None if entry is None else entry[0]
+
+    def get(self, project_id: int, version: Optional[str] = None, refresh: bool = False):
+        """Returns (json_project_meta, sly.ProjectMeta). The returned json is the repaired one."""
+
+        def _outdated(entry):
+            return entry is None or (version is not None and entry[0] != version)
+
+        with self._lock:
+            entry = self._entries.get(project_id)
+            fetch_lock = self._fetch_locks.setdefault(project_id, threading.Lock())
+        if refresh or _outdated(entry):
+            with fetch_lock:
+                with self._lock:
+                    entry = self._entries.get(project_id)
+                # another lookup may have fetched it while this one waited
+                if refresh or _outdated(entry):
+                    entry = [version, self._fetch_shared(project_id, version, refresh), None]
+                    with self._lock:
+                        self._entries[project_id] = entry
+                else:
+                    metrics.inc("meta_cache_requests_total", result="hit")
+        else:
+            metrics.inc("meta_cache_requests_total", result="hit")
+        if entry[2] is None:
+            with metrics.timer("meta_parse"):
+                entry = [entry[0], *self._parse(entry[1])]
+            with self._lock:
+                self._entries[project_id] = entry
+        return entry[1], entry[2]
+
+    def _fetch_shared(self, project_id: int, version: Optional[str], refresh: bool) -> dict:
+        # only versioned metas are shared, a meta without a version can not be told stale
+        shared_key = None
+        if self.shared is not None and version is not None:
+            shared_key = f"meta:{project_id}:{version}"
+            if not refresh:
+                data = self.shared.get(shared_key)
+                if data is not None:
+                    metrics.inc("meta_cache_requests_total", result="shared_hit")
+                    return json.loads(data)
+        metrics.inc("meta_cache_requests_total", result="miss")
+        json_project_meta = self._fetch(project_id)
+        if shared_key is not None:
+            self.shared.put(shared_key, json.dumps(json_project_meta).encode("utf-8"))
+        return json_project_meta
+
+    def save(self):
+        """Writes the metas with their versions to the snapshot file, atomically."""
+        if self.snapshot_path is None:
+            return
+        with self._lock:
+            snapshot = {
+                str(project_id): {"version": entry[0], "meta": entry[1]}
+                for project_id, entry in self._entries.items()
+            }
+        tmp_path = f"{self.snapshot_path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w") as file:
+            json.dump(snapshot, file)
+        os.replace(tmp_path, self.snapshot_path)
+        sly.logger.debug(f"Project metas snapshot saved: {len(snapshot)} projects")
+
+    def load(self) -> int:
+        """Fills the cache from the snapshot file, returns the number of loaded metas. Entries whose
+        project has changed since are refetched on first use as usual."""
+        if self.snapshot_path is None:
+            return 0
+        try:
+            with open(self.snapshot_path) as file:
+                snapshot = json.load(file)
+        except FileNotFoundError:
+            return 0
+        except (OSError, ValueError) as e:
+            sly.logger.warning(f"Failed to load the project metas snapshot: {repr(e)}")
+            return 0
+        with self._lock:
+            for project_id, entry in snapshot.items():
+                self._entries.setdefault(int(project_id), [entry["version"], entry["meta"], None])
+        sly.logger.info(f"Project metas snapshot: {len(snapshot)} projects loaded")
+        return len(snapshot)
+
+    def _parse(self, json_project_meta: dict):
+        from src.utils import handle_broken_project_meta
+
+        try:
+            return json_project_meta, sly.ProjectMeta.from_json(json_project_meta)
+        except Exception:  # Error: Supported only HEX RGB string format!
+            metrics.inc("repairs_total", kind="project_meta")
+            json_project_meta = handle_broken_project_meta(json_project_meta)
+            return json_project_meta, sly.ProjectMeta.from_json(json_project_meta)
@@ -0,0 +1,91 @@
+from functools import lru_cache
+from typing import List, Optional
+
+import cv2
+import numpy as np
+
+# rows processed at once when blending over an image, keeps temporaries small on huge frames
+BLEND_BAND_PIXELS = 1 << 20
+
+
+def layer_alpha(opacity: float) -> float:
+    # same value the old per-layer "(opacity - is_black) * 255" planes had on painted pixels
+    return float(opacity) * 255
+
+
+@lru_cache(maxsize=32)
+def blend_table(alpha: float) -> np.ndarray:
+    """table[color, background] == uint8(a * color + (1 - a) * background) for a = alpha / 255,
+    evaluated with the same float64 operations as the previous per-channel blending loop."""
+    a = np.float64(alpha) / 255.0
+    a_inv = 1.0 - a
+    values = np.arange(256, dtype=np.float64)
+    table = (a * values[:, None] + a_inv * values[None, :]).astype(np.uint8)
+    table.setflags(write=False)
+    return table
+
+
+class Compositor:
+    """Composes render layers into one preallocated RGBA buffer.
+
+    Layers are painted one by one into a shared RGB scratch buffer and folded into the output:
+    every non-zero channel of a later layer replaces the output channel, and every painted pixel
+    of a later layer replaces the pixel opacity level. Levels are turned into alpha (or blended
+    over the source image) only once at the end.
+    """
+
+    def __init__(self, height: int, width: int):
+        self.rgba = np.zeros((height, width, 4), dtype=np.uint8)
+        self.rgb = self.rgba[:, :, :3]
+        self.levels = np.zeros((height, width), dtype=np.uint8)
+        self.scratch = np.zeros((height, width, 3), dtype=np.uint8)
+        self.alphas: List[float] = [0.0]
+
+    def new_layer(self) -> np.ndarray:
+        self.scratch.fill(0)
+        return self.scratch
+
+    def fold_layer(self, opacity: float):
+        layer = self.scratch
+        np.copyto(self.rgb, layer, where=layer != 0)
+        alpha = layer_alpha(opacity)
+        if alpha == 0:
+            return
+        self.alphas.append(alpha)
+        painted = np.any(layer != 0, axis=-1)
+        self.levels[painted] = len(self.alphas) - 1
+
+    def alpha(self) -> np.ndarray:
+        lut = np.zeros(256, dtype=np.uint8)
+        for level, alpha in enumerate(self.alphas):
+            lut[level] = int(alpha)
+        return cv2.LUT(self.levels, lut)
+
+    def finish(self) -> np.ndarray:
+        self.rgba[:, :, 3] = self.alpha()
+        self.scratch = None
+        return self.rgba
+
+    def blend(self, bitmap: Optional[np.ndarray] = None) -> np.ndarray:
+        """Blend the composed layers over bitmap (or over black) and return an RGB image."""
+        height, width = self.levels.shape
+        if bitmap is not None:
+            result = np.ascontiguousarray(bitmap[:, :, :3], dtype=np.uint8).copy()
+        else:
+            result = np.zeros((height, width, 3), dtype=np.uint8)
+        band = max(1, BLEND_BAND_PIXELS // max(width, 1))
+        for top in range(0, height, band):
+            rows = slice(top, top + band)
+            levels = self.levels[rows]
+            for level in range(1, len(self.alphas)):
+                selected = levels == level
+                if not selected.any():
+                    continue
+                colors = self.rgb[rows][selected]
+                if self.alphas[level] == 255:
+                    result[rows][selected] = colors
+                    continue
+                background = result[rows][selected]
+                result[rows][selected] = blend_table(self.alphas[level])[colors, background]
+        self.scratch = None
+        return result
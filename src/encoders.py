@@ -0,0 +1,64 @@
+import cv2
+import numpy as np
+from fastapi import HTTPException
+
+# format name -> (file extension, media type)
+FORMATS = {
+    "png": (".png", "image/png"),
+    "webp": (".webp", "image/webp"),
+    "webp-lossless": (".webp", "image/webp"),
+    "jpeg": (".jpg", "image/jpeg"),
+}
+
+
+def negotiate(requested: str, accept: str, settings: dict, opaque: bool = False) -> str:
+    """Pick the output format: explicit `format` query parameter first, then the endpoint default
+    from settings. The "auto" default serves WebP to clients that accept it and PNG to the rest,
+    flat annotation-only renders compress better with lossless WebP (WEBP_LOSSLESS)."""
+    output_format = requested or settings.get("OUTPUT_FORMAT", "png")
+    if output_format == "auto":
+        if "image/webp" not in (accept or ""):
+            output_format = "png"
+        elif settings.get("WEBP_LOSSLESS", False):
+            output_format = "webp-lossless"
+        else:
+            output_format = "webp"
+    if output_format not in FORMATS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unsupported format '{output_format}'. Available formats: {', '.join(FORMATS)}",
+        )
+    if output_format == "jpeg" and not opaque:
+        raise HTTPException(
+            status_code=400, detail="JPEG is available only for renders without transparency"
+        )
+    return output_format
+
+
+def media_type(output_format: str) -> str:
+    return FORMATS[output_format][1]
+
+
+def extension(output_format: str) -> str:
+    return FORMATS[output_format][0]
+
+
+def encode(bgra: np.ndarray, output_format: str, settings: dict) -> bytes:
+    if output_format == "png":
+        level = settings.get("PNG_COMPRESSION")
+        params = [] if level is None else [cv2.IMWRITE_PNG_COMPRESSION, int(level)]
+        success, buffer = cv2.imencode(".png", bgra, params)
+    elif output_format == "webp":
+        quality = int(settings.get("WEBP_QUALITY", 90))
+        success, buffer = cv2.imencode(".webp", bgra, [cv2.IMWRITE_WEBP_QUALITY, min(quality, 100)])
+    elif output_format == "webp-lossless":
+        # quality above 100 switches libwebp to the lossless mode
+        success, buffer = cv2.imencode(".webp", bgra, [cv2.IMWRITE_WEBP_QUALITY, 101])
+    elif output_format == "jpeg":
+        quality = int(settings.get("JPEG_QUALITY", 90))
+        success, buffer = cv2.imencode(".jpg", bgra[:, :, :3], [cv2.IMWRITE_JPEG_QUALITY, quality])
+    else:
+        raise ValueError(f"Unsupported format '{output_format}'")
+    if not success:
+        raise RuntimeError(f"Failed to encode the render as {output_format}")
+    return buffer.tobytes()
@@ -1,9 +1,17 @@
 import json
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from dotenv import load_dotenv
 
 import supervisely as sly
+from src.admission import MemoryBudget
+from src.cache import AnnotationCache, MetaCache, RenderCache
+from src.render_pool import RenderPool
+from src.shared_cache import SharedCache
+from src.single_flight import SingleFlight
+from src.version_index import VersionIndex
 
 if sly.is_development():
     load_dotenv("local.env")
@@ -19,13 +27,118 @@ WORKSPACE_ID = sly.env.workspace_id()
 
 STORAGE_DIR = sly.app.get_data_dir()
 
+CACHE_MAX_AGE = int(os.environ.get("CACHE_MAX_AGE", 604800))
 
-def update_metas():
-    sly.logger.info("Loading project metas. Please wait...")
-    project_ids = [project.id for project in api.project.get_list(WORKSPACE_ID)]
-    project_metas_json = [api.project.get_meta(id) for id in project_ids]
-    sly.logger.info("Project meta successfully loaded")
-    return {k: v for k, v in zip(project_ids, project_metas_json)}
+# cache shared by the replicas of a scaled app: comma separated redis:// URLs and/or directories on
+# a volume mounted into every pod, keys are spread over them by consistent hashing
+SHARED_CACHE_URLS = [
+    url.strip() for url in os.environ.get("SHARED_CACHE_URLS", "").split(",") if url.strip()
+]
+SHARED_CACHE_TTL = int(os.environ.get("SHARED_CACHE_TTL", CACHE_MAX_AGE))
+# size limit of each directory node, Redis servers are limited by their own maxmemory
+SHARED_CACHE_DIR_MB = int(os.environ.get("SHARED_CACHE_DIR_MB", 16384))
+shared_cache = (
+    SharedCache(
+        SHARED_CACHE_URLS, ttl=SHARED_CACHE_TTL, directory_size=SHARED_CACHE_DIR_MB * 1024 * 1024
+    )
+    if SHARED_CACHE_URLS
+    else None
+)
 
+RENDER_CACHE_MEMORY_MB = int(os.environ.get("RENDER_CACHE_MEMORY_MB", 256))
+RENDER_CACHE_DISK_MB = int(os.environ.get("RENDER_CACHE_DISK_MB", 4096))
+render_cache = RenderCache(
+    os.path.join(STORAGE_DIR, "render_cache"),
+    memory_limit=RENDER_CACHE_MEMORY_MB * 1024 * 1024,
+    disk_limit=RENDER_CACHE_DISK_MB * 1024 * 1024,
+    shared=shared_cache,
+)
 
-JSON_METAS = update_metas() if sly.is_production() else {}
+# parsed annotations shared by the per-figure renders and tiles of an image, with render threads:
+# worker processes get the JSON and parse it themselves
+ANN_CACHE_MEMORY_MB = int(os.environ.get("ANN_CACHE_MEMORY_MB", 256))
+ann_cache = AnnotationCache(memory_limit=ANN_CACHE_MEMORY_MB * 1024 * 1024)
+
+version_index = VersionIndex(os.path.join(STORAGE_DIR, "versions.sqlite"), shared=shared_cache)
+
+# "thread" or "process", worker processes let renders use all the cores of the pod
+RENDER_BACKEND = os.environ.get("RENDER_BACKEND", "thread")
+RENDER_WORKERS = int(os.environ.get("RENDER_WORKERS", os.cpu_count() or 4))
+RENDER_MAX_TASKS_PER_WORKER = int(os.environ.get("RENDER_MAX_TASKS_PER_WORKER", 1000))
+RENDER_QUEUE_LIMIT = int(os.environ.get("RENDER_QUEUE_LIMIT", 256))
+render_pool = RenderPool(
+    RENDER_BACKEND,
+    workers=RENDER_WORKERS,
+    max_tasks_per_worker=RENDER_MAX_TASKS_PER_WORKER,
+    queue_limit=RENDER_QUEUE_LIMIT,
+)
+
+# renders are admitted by their estimated peak memory, cheap ones (thumbnails) have their own
+# lane and never wait behind full resolution renders
+RENDER_MEMORY_MB = int(os.environ.get("RENDER_MEMORY_MB", 1024))
+FAST_LANE_MEMORY_MB = int(os.environ.get("FAST_LANE_MEMORY_MB", 256))
+FAST_LANE_MAX_RENDER_MB = int(os.environ.get("FAST_LANE_MAX_RENDER_MB", 16))
+ADMISSION_QUEUE_LIMIT = int(os.environ.get("ADMISSION_QUEUE_LIMIT", 64))
+ADMISSION_TIMEOUT = int(os.environ.get("ADMISSION_TIMEOUT", 30))
+memory_budget = MemoryBudget(
+    "large",
+    RENDER_MEMORY_MB * 1024 * 1024,
+    queue_limit=ADMISSION_QUEUE_LIMIT,
+    timeout=ADMISSION_TIMEOUT,
+)
+fast_lane = MemoryBudget(
+    "fast",
+    FAST_LANE_MEMORY_MB * 1024 * 1024,
+    queue_limit=ADMISSION_QUEUE_LIMIT,
+    timeout=ADMISSION_TIMEOUT,
+)
+
+# identical renders requested at the same time are computed once
+SINGLE_FLIGHT_TIMEOUT = int(os.environ.get("SINGLE_FLIGHT_TIMEOUT", 60))
+single_flight = SingleFlight(timeout=SINGLE_FLIGHT_TIMEOUT)
+
+
+# metas are fetched on first use, a background refresh keeps them current and saves a snapshot
+# that a restarted server starts from
+META_REFRESH_WORKERS = int(os.environ.get("META_REFRESH_WORKERS", 8))
+meta_cache = MetaCache(
+    fetch=lambda project_id: api.project.get_meta(project_id),
+    snapshot_path=os.path.join(STORAGE_DIR, "project_metas.json"),
+    shared=shared_cache,
+)
+_refresh_lock = threading.Lock()
+
+
+def update_metas() -> bool:
+    """Fetches the metas of the workspace projects changed since they were cached, with
+    META_REFRESH_WORKERS requests at a time, and saves the snapshot. Returns False if another
+    refresh is already running."""
+    if not _refresh_lock.acquire(blocking=False):
+        return False
+    try:
+        projects = api.project.get_list(WORKSPACE_ID)
+        outdated = [p for p in projects if meta_cache.version(p.id) != p.updated_at]
+        sly.logger.info(f"Loading project metas: {len(outdated)} of {len(projects)} projects changed")
+        with ThreadPoolExecutor(META_REFRESH_WORKERS, thread_name_prefix="meta-refresh") as executor:
+            futures = {
+                executor.submit(meta_cache.get, project.id, project.updated_at): project
+                for project in outdated
+            }
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except Exception as e:
+                    sly.logger.warning(f"Failed to load meta of project {futures[future].id}: {repr(e)}")
+        meta_cache.save()
+        sly.logger.info("Project meta successfully loaded")
+        return True
+    finally:
+        _refresh_lock.release()
+
+
+def update_metas_in_background() -> bool:
+    """Starts update_metas in a thread, returns False if a refresh is already running."""
+    if _refresh_lock.locked():
+        return False
+    threading.Thread(target=update_metas, name="meta-refresh", daemon=True).start()
+    return True
@@ -1,117 +1,524 @@
+import asyncio
+import atexit
+import math
+import time
+from collections import defaultdict
 from pathlib import Path
-from typing import Literal, Union
+from typing import List, Literal, Optional, Union
 
-import cv2
 import requests
-from fastapi import HTTPException, Response
+from fastapi import APIRouter, HTTPException, Query, Request, Response
+from fastapi.routing import APIRoute
 
+import src.cache as c
+import src.encoders as encoders
 import src.globals as g
+import src.metrics as metrics
+import src.prerender as prerender
 import src.utils as u
 import supervisely as sly
-from src.ui import card_1, get_settings
+from src.ui import card_1, card_2, get_settings, show_prerender_status
 from supervisely.app.widgets import Container
 
-layout = Container(widgets=[card_1], direction="vertical")
+layout = Container(widgets=[card_1, card_2], direction="vertical")
 
 static_dir = Path(g.STORAGE_DIR)
 app = sly.Application(layout=layout, static_dir=static_dir)
 server = app.get_server()
 
+# here and not in src.globals: render worker processes import that module too (the forkserver
+# preloads it), only the server loads the metas
+if sly.is_production():
+    g.meta_cache.load()
+    atexit.register(g.meta_cache.save)
+    g.update_metas_in_background()
+
+prerender.job.on_progress = show_prerender_status
+show_prerender_status(prerender.job.status())
+
+
+@server.on_event("startup")
+async def start_prerender():
+    # pre-rendering runs its renders on the server event loop
+    prerender.job.loop = asyncio.get_running_loop()
+    prerender.job.resume()
+
+
+BATCH_LIMIT = 200
+TILE_MAX_PIXELS = 4096 * 4096
+
+metrics.gauge("render_queue_depth", g.render_pool.queued)
+metrics.gauge("single_flight_in_flight", g.single_flight.in_flight)
+metrics.gauge("render_memory_admitted_bytes", lambda: g.memory_budget.used + g.fast_lane.used)
+metrics.gauge("render_admission_waiting", lambda: g.memory_budget.waiting() + g.fast_lane.waiting())
+
+
+class MeteredRoute(APIRoute):
+    """Records latency, status and size of the responses of a route. A route class instead of a
+    middleware: in production sly.Application builds the middleware stack as it starts."""
+
+    def get_route_handler(self):
+        handler = super().get_route_handler()
+
+        async def measure_request(request: Request) -> Response:
+            endpoint = request.url.path
+            start = time.perf_counter()
+            status, size = 500, 0
+            try:
+                response = await handler(request)
+                status = response.status_code
+                size = int(response.headers.get("content-length", 0))
+                return response
+            except HTTPException as e:
+                status = e.status_code
+                raise
+            finally:
+                metrics.observe("request_seconds", time.perf_counter() - start, endpoint=endpoint)
+                metrics.inc("responses_total", endpoint=endpoint, status=status)
+                metrics.inc("response_bytes_total", size, endpoint=endpoint)
+
+        return measure_request
+
+
+renders = APIRouter(route_class=MeteredRoute)
+
+
+def not_modified(request: Request, headers: dict) -> bool:
+    return c.etag_matches(request.headers.get("if-none-match"), headers["ETag"])
+
+
+async def render_response(
+    request: Request,
+    project,
+    image,
+    settings: dict,
+    output_format: str,
+    cost: int,
+    error_context: str,
+    func,
+    *args,
+    figure_id: int = None,
+    region: str = None,
+    media_type: str = None,
+    vary: Optional[str] = "Accept",
+) -> Response:
+    """Response with func(image_id, project_id, project_meta, *args) rendered for the current version
+    of the image and its project. Answers 304 when the client has it already and serves the render
+    cache, otherwise renders it within `cost` bytes of the memory admission, once for all concurrent
+    requests. `figure_id` and `region` tell renders of the same image apart."""
+    media_type = media_type or encoders.media_type(output_format)
+    headers = {"Cache-Control": f"max-age={g.CACHE_MAX_AGE}", "Content-Type": media_type}
+    if vary is not None:
+        headers["Vary"] = vary
+    headers["ETag"] = c.etag(
+        image.id,
+        image.updated_at,
+        project.updated_at,
+        figure_id if region is None else region,
+        c.settings_hash(settings),
+        output_format,
+    )
+    if not_modified(request, headers):
+        return Response(status_code=304, headers=headers)
+    cache_key = c.render_key(
+        image.id, image.updated_at, project.updated_at, figure_id, settings, output_format, region
+    )
+    cached = await u.run_io(g.render_cache.get, cache_key)
+    if cached is not None:
+        return Response(cached, headers=headers, media_type=media_type)
+
+    async def _render():
+        async with u.admit(cost):
+            try:
+                _, project_meta = await u.run_io(g.meta_cache.get, project.id, project.updated_at)
+                annotation = await u.load_annotation(project, image, project_meta)
+                content = await u.run_cpu(
+                    func,
+                    image.id,
+                    project.id,
+                    project_meta,
+                    *args,
+                    output_format=output_format,
+                    settings=settings,
+                    **annotation,
+                )
+            except HTTPException as e:
+                # 503 of the render pool or the admission keeps its status and Retry-After
+                if e.status_code != 500:
+                    raise
+                raise HTTPException(status_code=500, detail=f"{error_context}. Error: {e.detail}")
+            except Exception as e:
+                raise e.__class__(f"{error_context}. Error: {str(e)}") from e
+
+        await u.run_io(g.render_cache.put, cache_key, content)
+        return content
+
+    content = await g.single_flight.run(cache_key, _render)
+    return Response(content, headers=headers, media_type=media_type)
+
+
+@server.get("/metrics")
+def metrics_endpoint():
+    return Response(metrics.render(), media_type="text/plain; version=0.0.4")
+
 
 @server.get("/refresh")
 def refresh_project_list():
+    """Refresh the project metas in the background, requests are served from the cache meanwhile."""
+    if g.update_metas_in_background():
+        return "Projects refresh started"
+    return "Projects refresh is already running"
+
+
+@server.get("/prerender")
+def prerender_endpoint(
+    project_id: int,
+    dataset_ids: List[int] = Query(None),
+    figures: Literal["0", "1"] = "0",
+    output_format: str = Query(None, alias="format"),
+):
+    """Start rendering the project (or the listed datasets) into the render cache in the background."""
     try:
-        g.JSON_METAS = g.update_metas()
-        return "Projects successfully refreshed"
-    except Exception as e:
-        return f"Error: {e}"
+        return prerender.job.start(project_id, dataset_ids, figures == "1", output_format)
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
 
 
-@server.get("/renders", response_class=Response)
-def image_endpoint(project_id: int, image_id: int, user_id: int = None, figure_id: int = None):
-    project = g.api.project.get_info_by_id(project_id, raise_error=True)
-    image = g.api.image.get_info_by_id(image_id)
+@server.get("/prerender/status")
+def prerender_status():
+    return prerender.job.status()
+
+
+@server.get("/prerender/stop")
+def prerender_stop():
+    return prerender.job.stop()
+
+
+@renders.get("/renders", response_class=Response)
+async def image_endpoint(
+    request: Request,
+    project_id: int,
+    image_id: int,
+    user_id: int = None,
+    figure_id: int = None,
+    output_format: str = Query(None, alias="format"),
+):
+    settings = get_settings()
+    output_format = encoders.negotiate(output_format, request.headers.get("accept"), settings)
+    project, image = await asyncio.gather(
+        u.run_io(g.api.project.get_info_by_id, project_id, raise_error=True),
+        u.run_io(g.api.image.get_info_by_id, image_id),
+    )
     if image is None:
         raise HTTPException(status_code=404, detail=f"Image with ID={image_id} not found")
 
-    try:
-        json_project_meta = g.JSON_METAS[project_id]
-    except (KeyError, TypeError):
-        json_project_meta = g.api.project.get_meta(project_id)
-        g.JSON_METAS[project_id] = json_project_meta
+    out_size = u.thumbnail_size((image.height, image.width), settings.get("OUTPUT_WIDTH_PX", 500))
+    return await render_response(
+        request,
+        project,
+        image,
+        settings,
+        output_format,
+        u.estimate_render_bytes(out_size),
+        f"USER_ID: {user_id}, TEAM_ID: {project.team_id}, WORKSPACE_ID: {project.workspace_id}, "
+        f"PROJECT_ID: {project_id}, IMAGE_ID: {image_id}",
+        u.get_rendered_image,
+        figure_id,
+        figure_id=figure_id,
+    )
 
-    if u.image_was_updated(project, image):
-        json_project_meta = g.api.project.get_meta(project_id, with_settings=True)
-        g.JSON_METAS[project_id] = json_project_meta
 
-    try:
-        success, image = u.get_rendered_image(
-            image_id, project_id, json_project_meta, figure_id=figure_id
+@renders.get("/renders/tile", response_class=Response)
+async def tile_endpoint(
+    request: Request,
+    project_id: int,
+    image_id: int,
+    x: int,
+    y: int,
+    w: int,
+    h: int,
+    zoom: int = 0,
+    output_format: str = Query(None, alias="format"),
+):
+    """Render the annotation of the (x, y, w, h) window of the image in full resolution pixels,
+    downscaled 2^zoom times. Only labels intersecting the window are rasterized."""
+    settings = get_settings()
+    output_format = encoders.negotiate(output_format, request.headers.get("accept"), settings)
+    project, image = await asyncio.gather(
+        u.run_io(g.api.project.get_info_by_id, project_id, raise_error=True),
+        u.run_io(g.api.image.get_info_by_id, image_id),
+    )
+    if image is None:
+        raise HTTPException(status_code=404, detail=f"Image with ID={image_id} not found")
+    if zoom < 0 or w <= 0 or h <= 0 or x < 0 or y < 0 or x >= image.width or y >= image.height:
+        raise HTTPException(status_code=400, detail="The tile is outside of the image")
+    w, h = min(w, image.width - x), min(h, image.height - y)
+    if w * h / 4**zoom > TILE_MAX_PIXELS:
+        raise HTTPException(status_code=400, detail="The tile is too large, increase the zoom level")
+
+    region = f"{x}:{y}:{w}:{h}:{zoom}"
+    out_size = (math.ceil(h / 2**zoom), math.ceil(w / 2**zoom))
+    return await render_response(
+        request,
+        project,
+        image,
+        settings,
+        output_format,
+        u.estimate_render_bytes(out_size),
+        f"PROJECT_ID: {project_id}, IMAGE_ID: {image_id}, TILE: {region}",
+        u.get_rendered_tile,
+        y,
+        x,
+        h,
+        w,
+        zoom,
+        region=region,
+    )
+
+
+@renders.get("/renders/figures", response_class=Response)
+async def figures_endpoint(
+    request: Request,
+    project_id: int,
+    image_id: int,
+    figure_ids: List[int] = Query(None),
+    output_format: str = Query(None, alias="format"),
+):
+    """Render every figure of the image (or the listed ones) separately, as /renders?figure_id does,
+    in one pass and return them as a zip archive with a sprite sheet and its index.json."""
+    settings = get_settings()
+    output_format = encoders.negotiate(output_format, None, settings)
+    project, image = await asyncio.gather(
+        u.run_io(g.api.project.get_info_by_id, project_id, raise_error=True),
+        u.run_io(g.api.image.get_info_by_id, image_id),
+    )
+    if image is None:
+        raise HTTPException(status_code=404, detail=f"Image with ID={image_id} not found")
+    if figure_ids is not None:
+        figure_ids = sorted(set(figure_ids))
+
+    region = "figures:" + ("all" if figure_ids is None else ",".join(map(str, figure_ids)))
+    # the sprite holds at most about as many pixels as the frame
+    frame_size = u.thumbnail_size((image.height, image.width), settings.get("OUTPUT_WIDTH_PX", 500))
+    return await render_response(
+        request,
+        project,
+        image,
+        settings,
+        output_format,
+        2 * u.estimate_render_bytes(frame_size),
+        f"PROJECT_ID: {project_id}, IMAGE_ID: {image_id}",
+        u.get_rendered_figures,
+        figure_ids,
+        region=region,
+        media_type="application/zip",
+        vary=None,
+    )
+
+
+@renders.get("/renders/batch", response_class=Response)
+async def batch_endpoint(
+    project_id: int,
+    image_ids: List[int] = Query(None),
+    dataset_id: int = None,
+    after_id: int = 0,
+    limit: int = BATCH_LIMIT,
+    output_format: str = Query(None, alias="format"),
+):
+    """Render previews for a list of images, or a page of a dataset, and return them as a zip archive
+    of `<image_id>.<ext>` files. Pages are addressed by image ID: pass the `X-Next-After-Id` header
+    of the previous response as `after_id` to get the next one. A batch holds at most `limit` images
+    (BATCH_LIMIT at most), a longer list of image_ids is rejected."""
+    if image_ids is None and dataset_id is None:
+        raise HTTPException(status_code=400, detail="Either image_ids or dataset_id must be specified")
+    if limit < 1:
+        raise HTTPException(status_code=400, detail="limit must be a positive number")
+    limit = min(limit, BATCH_LIMIT)
+    if image_ids is not None and len(image_ids) > limit:
+        raise HTTPException(
+            status_code=400, detail=f"At most {limit} image_ids can be rendered in one batch, got {len(image_ids)}"
         )
+    settings = get_settings()
+    output_format = encoders.negotiate(output_format, None, settings)
 
-    except HTTPException as e:
-        new_error_message = f"USER_ID: {user_id}, TEAM_ID: {project.team_id}, WORKSPACE_ID: {project.workspace_id}, PROJECT_ID: {project_id}, IMAGE_ID: {image_id}. Error: {e.detail}"
-        raise HTTPException(status_code=500, detail=new_error_message)
-    except Exception as e:
-        new_error_message = f"USER_ID: {user_id}, TEAM_ID: {project.team_id}, WORKSPACE_ID: {project.workspace_id}, PROJECT_ID: {project_id}, IMAGE_ID: {image_id}. Error: {str(e)}"
-        raise e.__class__(new_error_message) from e
+    errors = {}
+    if image_ids is not None:
+        images_task = u.run_io(u.get_image_infos, image_ids)
+    else:
+        filters = [{"field": "id", "operator": ">", "value": after_id}]
+        images_task = u.run_io(
+            g.api.image.get_list, dataset_id, filters=filters, sort="id", sort_order="asc", limit=limit
+        )
+    project, images = await asyncio.gather(
+        u.run_io(g.api.project.get_info_by_id, project_id, raise_error=True), images_task
+    )
+    if image_ids is not None:
+        errors.update({i: f"Image with ID={i} not found" for i in image_ids if i not in images})
+        images = [images[i] for i in image_ids if i in images]
+    page = images
+    images = [image for image in page if image.project_id == project_id]
+    for image in page:
+        if image.project_id != project_id:
+            errors[image.id] = f"Image with ID={image.id} is not in the project ID={project_id}"
+
+    results, missed = {}, []
+    for image in images:
+        cache_key = c.render_key(
+            image.id, image.updated_at, project.updated_at, None, settings, output_format
+        )
+        cached = await u.run_io(g.render_cache.get, cache_key)
+        if cached is not None:
+            results[image.id] = cached
+        else:
+            missed.append((image, cache_key))
+
+    if len(missed) > 0:
+        by_dataset = defaultdict(list)
+        for image, _ in missed:
+            by_dataset[image.dataset_id].append(image.id)
+        tasks = [u.run_io(g.meta_cache.get, project_id, project.updated_at)]
+        for ds_id, ds_image_ids in by_dataset.items():
+            tasks.append(u.run_io(g.api.annotation.download_json_batch, ds_id, ds_image_ids))
+        (_, project_meta), *batches = await asyncio.gather(*tasks)
+        janns = {}
+        for ds_image_ids, batch in zip(by_dataset.values(), batches):
+            janns.update(zip(ds_image_ids, batch))
+
+        async def _render_and_cache(image, cache_key):
+            out_size = u.thumbnail_size((image.height, image.width), settings.get("OUTPUT_WIDTH_PX", 500))
+            async with u.admit(u.estimate_render_bytes(out_size)):
+                content = await u.run_cpu(
+                    u.get_rendered_image,
+                    image.id,
+                    project_id,
+                    project_meta,
+                    jann=janns[image.id],
+                    output_format=output_format,
+                    settings=settings,
+                )
+            await u.run_io(g.render_cache.put, cache_key, content)
+            return content
+
+        async def _render(image, cache_key):
+            try:
+                results[image.id] = await g.single_flight.run(
+                    cache_key, lambda: _render_and_cache(image, cache_key)
+                )
+            except HTTPException as e:
+                errors[image.id] = e.detail
+            except Exception as e:
+                sly.logger.warning(f"PROJECT_ID: {project_id}, IMAGE_ID: {image.id}. Error: {e}")
+                errors[image.id] = str(e)
+
+        await asyncio.gather(*[_render(image, cache_key) for image, cache_key in missed])
 
-    headers = {"Cache-Control": "max-age=604800", "Content-Type": "image/png"}
-    return Response(image.tobytes(), headers=headers, media_type="image/png")
+    renders = [(image.id, results[image.id]) for image in images if image.id in results]
+    archive = await u.run_cpu(u.zip_renders, renders, errors, encoders.extension(output_format))
+    headers = {"Cache-Control": "no-cache", "Content-Type": "application/zip"}
+    if dataset_id is not None and image_ids is None and len(page) == limit:
+        headers["X-Next-After-Id"] = str(page[-1].id)
+    return Response(archive, headers=headers, media_type="application/zip")
 
 
-@server.get("/render-on-image", response_class=Response)
-def render_on_img_endpoint(
+@renders.get("/render-on-image", response_class=Response)
+async def render_on_img_endpoint(
+    request: Request,
     image_id: int,
     classname: Literal["0", "1"] = "0",
     tags: Literal["0", "1"] = "0",
     onlyann: Literal["0", "1"] = "0",
+    output_format: str = Query(None, alias="format"),
+    width: int = Query(None, ge=1),
+    max_side: int = Query(None, ge=1),
+    full: Literal["0", "1"] = "0",
 ):
-
+    """Annotations drawn over the image. The image is rendered with its longest side bounded by
+    `max_side` (MAX_SIDE_PX by default) or at `width`; `full=1` renders the full resolution."""
+    # annotations are always blended over the image or over black, the result has no transparency
+    settings = get_settings("render-on-image")
+    output_format = encoders.negotiate(
+        output_format, request.headers.get("accept"), settings, opaque=True
+    )
+    project_id = None
     try:
-        image_info = g.api.image.get_info_by_id(image_id)
+        image_info = await u.run_io(g.api.image.get_info_by_id, image_id)
         if image_info is None:
             raise ValueError(f"The image {image_id} is not existed.")
 
-        dataset = g.api.dataset.get_info_by_id(image_info.dataset_id)
-        json_project_meta = g.api.project.get_meta(dataset.project_id)
-        project_meta = sly.ProjectMeta.from_json(json_project_meta)
-
-        jann = g.api.annotation.download_json(image_id)
-        ann = sly.Annotation.from_json(jann, project_meta)
-
         draw_class_names = True if classname == "1" else False
         draw_tags = True if tags == "1" else False
         with_image = True if onlyann == "0" else False
-        np_image = g.api.image.download_np(image_id) if with_image else None
-
-        settings = get_settings("render-on-image")
-        rgba, _, _ = u.get_rgba_np(
-            ann,
-            settings.get("OUTPUT_WIDTH_PX", 500),
-            settings.get("BBOX_THICKNESS_PERCENT", 0.5),
-            settings.get("BBOX_OPACITY", 1),
-            settings.get("FILLBBOX_OPACITY", 0.2),
-            settings.get("MASK_OPACITY", 0.7),
-            dataset.project_id,
-            image_id,
-            draw_class_names,
-            draw_tags,
-            with_image,
-            np_image,
-            skip_resize=True,
-            render_heatmap=settings.get("RENDER_HEATMAPS", False),
-            heatmap_threshold=settings.get("HEATMAP_THRESHOLD", 0.2),
-        )
 
-        rgba = cv2.cvtColor(rgba.astype("uint8"), cv2.COLOR_RGBA2BGRA)
-        success, im = cv2.imencode(".png", rgba)
+        project_id = image_info.project_id
+        if project_id is None:
+            dataset = await u.run_io(g.api.dataset.get_info_by_id, image_info.dataset_id)
+            project_id = dataset.project_id
+        project = await u.run_io(g.api.project.get_info_by_id, project_id, raise_error=True)
 
+        out_size = None
+        if full == "0":
+            max_side = max_side or settings.get("MAX_SIDE_PX")
+            out_size = u.get_output_size((image_info.height, image_info.width), width, max_side)
+
+        media_type = encoders.media_type(output_format)
+        headers = {
+            "Cache-Control": f"max-age={g.CACHE_MAX_AGE}",
+            "Content-Type": media_type,
+            "Vary": "Accept",
+            "ETag": c.etag(
+                image_id,
+                image_info.updated_at,
+                project.updated_at,
+                classname,
+                tags,
+                onlyann,
+                out_size,
+                c.settings_hash(settings),
+                output_format,
+            ),
+        }
+        if not_modified(request, headers):
+            return Response(status_code=304, headers=headers)
+
+        async def _get_np_image():
+            if not with_image:
+                return None
+            return await u.run_io(u.download_np_resized, image_info, out_size)
+
+        render_size = out_size or (image_info.height, image_info.width)
+        cost = u.estimate_render_bytes(render_size, render_size if with_image else None)
+
+        async def _render():
+            async with u.admit(cost):
+                (_, project_meta), jann, np_image = await asyncio.gather(
+                    u.run_io(g.meta_cache.get, project_id, project.updated_at),
+                    u.run_io(g.api.annotation.download_json, image_id),
+                    _get_np_image(),
+                )
+                return await u.run_cpu(
+                    u.get_rendered_on_image,
+                    jann,
+                    project_meta,
+                    project_id,
+                    image_id,
+                    draw_class_names,
+                    draw_tags,
+                    with_image,
+                    np_image,
+                    output_format=output_format,
+                    output_width=out_size[1] if out_size is not None else None,
+                    settings=settings,
+                )
+
+        content = await g.single_flight.run(("render-on-image", headers["ETag"]), _render)
+
+    except HTTPException:
+        raise
     except Exception as e:
-        new_error_message = (
-            f"PROJECT_ID: {dataset.project_id}, IMAGE_ID: {image_id}. Error: {str(e)}"
-        )
+        new_error_message = f"PROJECT_ID: {project_id}, IMAGE_ID: {image_id}. Error: {str(e)}"
         raise e.__class__(new_error_message) from e
 
-    headers = {"Cache-Control": "max-age=604800", "Content-Type": "image/png"}
-    return Response(im.tobytes(), headers=headers, media_type="image/png")
+    return Response(content, headers=headers, media_type=media_type)
+
+
+server.include_router(renders)
@@ -0,0 +1,160 @@
+import bisect
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+# seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+_lock = threading.Lock()
+_counters = defaultdict(float)  # (name, labels) -> value
+_histograms = {}  # (name, labels) -> [bucket counts, sum, count]
+_gauges = {}  # name -> callable
+_help = {}  # name -> (type, help text)
+
+# samples recorded by a render worker process during one call, sent back with its result
+_recording = threading.local()
+
+
+def describe(name: str, kind: str, text: str):
+    _help[name] = (kind, text)
+
+
+def inc(name: str, value: float = 1, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        _counters[key] += value
+    samples = getattr(_recording, "samples", None)
+    if samples is not None:
+        samples.append(("inc", name, value, labels))
+
+
+def observe(name: str, value: float, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = [[0] * len(BUCKETS), 0.0, 0]
+        index = bisect.bisect_left(BUCKETS, value)
+        if index < len(BUCKETS):
+            histogram[0][index] += 1
+        histogram[1] += value
+        histogram[2] += 1
+    samples = getattr(_recording, "samples", None)
+    if samples is not None:
+        samples.append(("observe", name, value, labels))
+
+
+def gauge(name: str, func):
+    _gauges[name] = func
+
+
+@contextmanager
+def timer(stage: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe("render_stage_seconds", time.perf_counter() - start, stage=stage)
+
+
+class Stopwatch:
+    """Splits the time of one render between stages: lap(stage) adds the time since the previous
+    lap to the stage, stop() records every stage once."""
+
+    def __init__(self):
+        self._last = time.perf_counter()
+        self._stages = defaultdict(float)
+
+    def lap(self, stage: str):
+        now = time.perf_counter()
+        self._stages[stage] += now - self._last
+        self._last = now
+
+    def stop(self):
+        for stage, seconds in self._stages.items():
+            observe("render_stage_seconds", seconds, stage=stage)
+        self._stages.clear()
+
+
+def call_recorded(func, *args, **kwargs):
+    """Runs func in a render worker process and returns its result with the metric samples it
+    recorded, the server process adds them to its own metrics with merge()."""
+    _recording.samples = []
+    try:
+        return func(*args, **kwargs), _recording.samples
+    finally:
+        _recording.samples = None
+
+
+def merge(samples: list):
+    for kind, name, value, labels in samples:
+        if kind == "inc":
+            inc(name, value, **labels)
+        else:
+            observe(name, value, **labels)
+
+
+def _format_labels(labels, extra=()) -> str:
+    items = list(labels) + list(extra)
+    if len(items) == 0:
+        return ""
+    escaped = [(key, str(value).replace("\\", "\\\\").replace('"', '\\"')) for key, value in items]
+    return "{" + ",".join(f'{key}="{value}"' for key, value in escaped) + "}"
+
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+def render() -> str:
+    """All the metrics in the Prometheus text exposition format."""
+    with _lock:
+        counters = sorted(_counters.items())
+        histograms = sorted((key, [list(h[0]), h[1], h[2]]) for key, h in _histograms.items())
+    lines, described = [], set()
+
+    def _header(name, kind):
+        if name in described:
+            return
+        described.add(name)
+        kind, text = _help.get(name, (kind, name))
+        lines.append(f"# HELP {name} {text}")
+        lines.append(f"# TYPE {name} {kind}")
+
+    for (name, labels), value in counters:
+        _header(name, "counter")
+        lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+    for (name, labels), (buckets, total, count) in histograms:
+        _header(name, "histogram")
+        cumulative = 0
+        for bound, bucket in zip(BUCKETS, buckets):
+            cumulative += bucket
+            lines.append(f"{name}_bucket{_format_labels(labels, [('le', f'{bound:g}')])} {cumulative}")
+        lines.append(f"{name}_bucket{_format_labels(labels, [('le', '+Inf')])} {count}")
+        lines.append(f"{name}_sum{_format_labels(labels)} {_format_value(total)}")
+        lines.append(f"{name}_count{_format_labels(labels)} {count}")
+    for name, func in sorted(_gauges.items()):
+        _header(name, "gauge")
+        lines.append(f"{name} {_format_value(func())}")
+    return "\n".join(lines) + "\n"
+
+
+describe("render_stage_seconds", "histogram", "Time spent in each stage of rendering")
+describe("io_seconds", "histogram", "Time of blocking calls: upstream API requests and disk access")
+describe("io_calls_total", "counter", "Blocking calls: upstream API requests and disk access")
+describe("request_seconds", "histogram", "Request latency by endpoint")
+describe("responses_total", "counter", "Responses by endpoint and status code")
+describe("response_bytes_total", "counter", "Response body bytes by endpoint")
+describe("render_cache_requests_total", "counter", "Render cache lookups by result")
+describe("annotation_cache_requests_total", "counter", "Parsed annotation cache lookups by result")
+describe("meta_cache_requests_total", "counter", "Project meta cache lookups by result")
+describe("repairs_total", "counter", "Broken project metas and annotations repaired")
+describe("dropped_objects_total", "counter", "Objects dropped from broken annotations by reason")
+describe("render_queue_depth", "gauge", "Renders waiting for or running in the render pool")
+describe("single_flight_in_flight", "gauge", "Distinct renders in progress")
+describe("render_memory_admitted_bytes", "gauge", "Estimated peak memory of the admitted renders")
+describe("render_admission_waiting", "gauge", "Renders waiting for memory to be admitted")
+describe("admission_rejected_total", "counter", "Renders rejected with 503 by memory lane")
+describe("shared_cache_requests_total", "counter", "Shared cache lookups by result, errors included")
@@ -0,0 +1,305 @@
+import asyncio
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
+
+from fastapi import HTTPException
+
+import src.cache as c
+import src.encoders as encoders
+import src.globals as g
+import src.utils as u
+import supervisely as sly
+from src.ui import get_settings
+
+PRERENDER_WORKERS = int(os.environ.get("PRERENDER_WORKERS", 2))
+PRERENDER_PAGE_SIZE = int(os.environ.get("PRERENDER_PAGE_SIZE", 200))
+PRERENDER_API_RPS = float(os.environ.get("PRERENDER_API_RPS", 5))
+
+
+class RateLimiter:
+    """Spaces calls at least 1 / rate seconds apart across all threads."""
+
+    def __init__(self, rate: float):
+        self.interval = 1 / rate if rate > 0 else 0
+        self._lock = threading.Lock()
+        self._next = time.monotonic()
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            delay = self._next - now
+            self._next = max(self._next, now) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+class PrerenderJob:
+    """Background job that renders every image of a project (or of some of its datasets) into the
+    render cache, so the first visitors of a published dataset get cached previews.
+
+    Datasets are walked page by page in image ID order. The position is saved to `state_path` after
+    every page and a job interrupted by a restart continues from there. Images already cached for
+    their current `updated_at` are skipped, upstream API calls are limited to `api_rps` per second.
+    Renders go through the render pool and the memory admission of the server event loop `loop` like
+    the renders of requests, and wait while the server is too busy.
+    """
+
+    def __init__(
+        self,
+        state_path: str,
+        workers: int = PRERENDER_WORKERS,
+        page_size: int = PRERENDER_PAGE_SIZE,
+        api_rps: float = PRERENDER_API_RPS,
+    ):
+        self.state_path = state_path
+        self.workers = workers
+        self.page_size = page_size
+        self.limiter = RateLimiter(api_rps)
+        self.on_progress = None  # called with the status after every page
+        self.loop = None  # event loop of the server, set on its startup
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.state = self._load_state()
+
+    def is_running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def status(self) -> dict:
+        with self._lock:
+            return dict(self.state or {"status": "idle"})
+
+    def start(
+        self,
+        project_id: int,
+        dataset_ids: Optional[List[int]] = None,
+        figures: bool = False,
+        output_format: Optional[str] = None,
+    ) -> dict:
+        if self.is_running():
+            raise RuntimeError("Pre-rendering is already running")
+        if self.loop is None:
+            raise RuntimeError("The server has not started yet")
+        datasets = self._call(g.api.dataset.get_list, project_id, recursive=True)
+        if dataset_ids is not None:
+            datasets = [dataset for dataset in datasets if dataset.id in dataset_ids]
+        # browsers accept WebP, render the format they will request
+        output_format = encoders.negotiate(output_format, "image/webp", get_settings())
+        with self._lock:
+            self.state = {
+                "status": "running",
+                "project_id": project_id,
+                "dataset_ids": [dataset.id for dataset in datasets],
+                "figures": figures,
+                "format": output_format,
+                "dataset_index": 0,
+                "after_id": 0,
+                "total": sum(dataset.images_count or 0 for dataset in datasets),
+                "rendered": 0,
+                "skipped": 0,
+                "failed": 0,
+                "error": None,
+            }
+        self._save_state()
+        self._run_in_background()
+        return self.status()
+
+    def resume(self):
+        if self.loop is None:
+            return
+        if self.state is not None and self.state["status"] == "running" and not self.is_running():
+            sly.logger.info(f"Resuming pre-rendering of project {self.state['project_id']}")
+            self._run_in_background()
+
+    def stop(self) -> dict:
+        if self.is_running():
+            self._stop.set()
+            self._thread.join()
+        return self.status()
+
+    def _run_in_background(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="prerender", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        state = self.state
+        executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="prerender")
+        try:
+            while state["dataset_index"] < len(state["dataset_ids"]):
+                if self._stop.is_set():
+                    self._update(status="stopped")
+                    return
+                dataset_id = state["dataset_ids"][state["dataset_index"]]
+                filters = [{"field": "id", "operator": ">", "value": state["after_id"]}]
+                images = self._call(
+                    g.api.image.get_list,
+                    dataset_id,
+                    filters=filters,
+                    sort="id",
+                    sort_order="asc",
+                    limit=self.page_size,
+                )
+                if len(images) == 0:
+                    self._update(dataset_index=state["dataset_index"] + 1, after_id=0)
+                    continue
+                page = self._render_page(executor, dataset_id, images)
+                if page is None:
+                    continue  # stopped within the page, it is walked again on resume
+                rendered, skipped, failed = page
+                self._update(
+                    after_id=images[-1].id,
+                    rendered=state["rendered"] + rendered,
+                    skipped=state["skipped"] + skipped,
+                    failed=state["failed"] + failed,
+                )
+            self._update(status="finished")
+        except Exception as e:
+            sly.logger.warning(f"Pre-rendering of project {state['project_id']} failed: {repr(e)}")
+            self._update(status="failed", error=str(e))
+        finally:
+            executor.shutdown(wait=False)
+
+    def _render_page(self, executor: ThreadPoolExecutor, dataset_id: int, images: list):
+        """Renders the images of a page missing from the cache, returns the numbers of rendered,
+        skipped and failed ones, or None if the job was stopped before the page was done."""
+        state = self.state
+        project_id, output_format = state["project_id"], state["format"]
+        settings = get_settings()
+
+        project = self._call(g.api.project.get_info_by_id, project_id, raise_error=True)
+        missed = []
+        for image in images:
+            cache_key = c.render_key(
+                image.id, image.updated_at, project.updated_at, None, settings, output_format
+            )
+            if cache_key in g.render_cache and (
+                not state["figures"] or g.version_index.get(image.id) == image.updated_at
+            ):
+                continue
+            missed.append((image, cache_key))
+        if len(missed) == 0:
+            return 0, len(images), 0
+
+        _, project_meta = g.meta_cache.get(project_id, project.updated_at)
+        janns = self._call(
+            g.api.annotation.download_json_batch, dataset_id, [image.id for image, _ in missed]
+        )
+
+        def _render(image, cache_key, jann):
+            try:
+                if g.render_pool.backend == "process":
+                    # worker processes parse the JSON themselves, like in u.load_annotation
+                    annotation = {"jann": jann}
+                    figure_ids = [obj["id"] for obj in jann["objects"]]
+                else:
+                    ann = u.parse_annotation(image.id, project_id, project_meta, jann)
+                    annotation = {"ann": ann}
+                    figure_ids = [label.sly_id for label in ann.labels]
+                out_size = u.thumbnail_size(
+                    (image.height, image.width), settings.get("OUTPUT_WIDTH_PX", 500)
+                )
+                cost = u.estimate_render_bytes(out_size)
+                for figure_id in [None, *figure_ids] if state["figures"] else [None]:
+                    if self._stop.is_set():
+                        return None
+                    key = cache_key
+                    if figure_id is not None:
+                        key = c.render_key(
+                            image.id,
+                            image.updated_at,
+                            project.updated_at,
+                            figure_id,
+                            settings,
+                            output_format,
+                        )
+                        if key in g.render_cache:
+                            continue
+                    try:
+                        content = self._render_on_server(
+                            cost,
+                            u.get_rendered_image,
+                            image.id,
+                            project_id,
+                            project_meta,
+                            figure_id=figure_id,
+                            output_format=output_format,
+                            settings=settings,
+                            **annotation,
+                        )
+                    except HTTPException as e:
+                        if figure_id is None or e.status_code != 404:
+                            raise
+                        continue  # a broken figure dropped when the annotation was repaired
+                    g.render_cache.put(key, content)
+                if state["figures"]:
+                    g.version_index.set(image.id, image.updated_at, project_id)
+                return True
+            except Exception as e:
+                sly.logger.warning(f"PROJECT_ID: {project_id}, IMAGE_ID: {image.id}. Error: {e}")
+                return False
+
+        results = list(
+            executor.map(
+                lambda args: _render(*args),
+                [(image, cache_key, jann) for (image, cache_key), jann in zip(missed, janns)],
+            )
+        )
+        if None in results:
+            return None
+        rendered = sum(results)
+        return rendered, len(images) - len(missed), len(results) - rendered
+
+    def _render_on_server(self, cost: int, func, *args, **kwargs) -> bytes:
+        """Runs the render on the server event loop once the memory admission lets it in, retries
+        after Retry-After while the server is too busy."""
+
+        async def _render():
+            async with u.admit(cost):
+                return await u.run_cpu(func, *args, **kwargs)
+
+        while True:
+            try:
+                return asyncio.run_coroutine_threadsafe(_render(), self.loop).result()
+            except HTTPException as e:
+                if e.status_code != 503 or self._stop.is_set():
+                    raise
+                self._stop.wait(int(e.headers.get("Retry-After", 5)))
+
+    def _call(self, func, *args, **kwargs):
+        self.limiter.wait()
+        return func(*args, **kwargs)
+
+    def _update(self, **changes):
+        with self._lock:
+            self.state.update(changes)
+        self._save_state()
+        if self.on_progress is not None:
+            try:
+                self.on_progress(self.status())
+            except Exception as e:
+                sly.logger.debug(f"Failed to report pre-rendering progress: {repr(e)}")
+
+    def _load_state(self) -> Optional[dict]:
+        if not os.path.exists(self.state_path):
+            return None
+        try:
+            with open(self.state_path) as file:
+                return json.load(file)
+        except (OSError, ValueError) as e:
+            sly.logger.warning(f"Failed to read the pre-rendering state: {e}")
+            return None
+
+    def _save_state(self):
+        state = self.status()
+        tmp_path = f"{self.state_path}.tmp"
+        with open(tmp_path, "w") as file:
+            json.dump(state, file)
+        os.replace(tmp_path, self.state_path)
+
+
+job = PrerenderJob(os.path.join(g.STORAGE_DIR, "prerender.json"))
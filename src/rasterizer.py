@@ -0,0 +1,165 @@
+from typing import Dict, List
+
+import cv2
+import numpy as np
+
+import supervisely as sly
+
+# geometries drawn by the SDK with a single color, they go to the color index buffer
+_INDEXED = (sly.Rectangle, sly.OrientedBBox, sly.Polygon, sly.Polyline, sly.Bitmap, sly.Point)
+_MAX_COLORS = np.iinfo(np.uint16).max
+
+
+class IndexBuffer:
+    """Labels of one layer rasterized into a buffer of color indices instead of RGB pixels, the
+    layer is colored from it in one pass. Every label is drawn in order over the previous ones, so
+    the result is the same as drawing them one by one. Consecutive lines of one color and
+    thickness are collected and drawn with one cv2.polylines call."""
+
+    def __init__(self, layer: np.ndarray, track_regions: bool = False):
+        self.layer = layer
+        self.index = np.zeros(layer.shape[:2], dtype=np.uint16)
+        self.colors = {}  # color -> index
+        self.dirty = False
+        # bounds of everything drawn since the last flush, when the buffer is flushed often
+        self.regions = [] if track_regions else None
+        self._lines = []
+        self._lines_key = None  # (closed, color index, thickness)
+
+    def mark(self, bbox: sly.Rectangle, pad: int):
+        if self.regions is not None:
+            self.regions.append((bbox.top - pad, bbox.left - pad, bbox.bottom + pad, bbox.right + pad))
+
+    def color_index(self, color) -> int:
+        color = tuple(int(channel) for channel in color)
+        value = self.colors.get(color)
+        if value is None:
+            if len(self.colors) == _MAX_COLORS - 1:
+                self.flush()
+            value = self.colors[color] = len(self.colors) + 1
+        return value
+
+    def lines(self, points: np.ndarray, closed: bool, color, thickness: int):
+        key = (closed, self.color_index(color), thickness)
+        if key != self._lines_key:
+            self._draw_lines()
+            self._lines_key = key
+        self._lines.append(points)
+
+    def draw(self, func, *args):
+        """func(index, *args) rasterizes one label with its color index."""
+        self._draw_lines()
+        func(self.index, *args)
+        self.dirty = True
+
+    def flush(self):
+        """Colors the layer with everything drawn so far and empties the buffer."""
+        self._draw_lines()
+        if self.dirty:
+            lut = np.zeros((len(self.colors) + 1, 3), dtype=np.uint8)
+            for color, value in self.colors.items():
+                lut[value] = color[:3]
+            for rows, cols in self._flushed_slices():
+                index = self.index[rows, cols]
+                painted = index != 0
+                self.layer[rows, cols][painted] = lut[index[painted]]
+                index.fill(0)
+            self.dirty = False
+        self.colors.clear()
+        if self.regions is not None:
+            self.regions.clear()
+
+    def _flushed_slices(self):
+        height, width = self.index.shape
+        whole = [(slice(None), slice(None))]
+        if self.regions is None:
+            return whole
+        slices, area = [], 0
+        for top, left, bottom, right in self.regions:
+            top, left = max(top, 0), max(left, 0)
+            bottom, right = min(bottom, height - 1), min(right, width - 1)
+            if bottom < top or right < left:
+                continue
+            area += (bottom - top + 1) * (right - left + 1)
+            if area >= height * width:
+                return whole
+            slices.append((slice(top, bottom + 1), slice(left, right + 1)))
+        return slices
+
+    def _draw_lines(self):
+        if len(self._lines) == 0:
+            return
+        closed, value, thickness = self._lines_key
+        cv2.polylines(self.index, self._lines, isClosed=closed, color=value, thickness=thickness)
+        self._lines, self._lines_key = [], None
+        self.dirty = True
+
+
+def _fill_polygon(index: np.ndarray, geometry: sly.Polygon, value: int):
+    # Polygon.draw fills a mask of the whole frame for every polygon, only its bounds are needed
+    exterior = geometry.exterior_np[:, ::-1].astype(np.int32)
+    if len(geometry.interior) == 0:
+        cv2.fillPoly(index, [exterior], value)
+        return
+    left, top = np.maximum(exterior.min(axis=0), 0)
+    right, bottom = np.minimum(exterior.max(axis=0), [index.shape[1] - 1, index.shape[0] - 1])
+    if right < left or bottom < top:
+        return
+    offset = np.array([left, top], dtype=np.int32)
+    mask = np.zeros((bottom - top + 1, right - left + 1), dtype=np.uint8)
+    cv2.fillPoly(mask, [exterior - offset], 1)
+    interior = [points[:, ::-1].astype(np.int32) - offset for points in geometry.interior_np]
+    cv2.fillPoly(mask, interior, 0)
+    index[top : bottom + 1, left : right + 1][mask.astype(bool)] = value
+
+
+def _corners(geometry) -> np.ndarray:
+    if type(geometry) == sly.Rectangle:
+        left, top, right, bottom = geometry.left, geometry.top, geometry.right, geometry.bottom
+        return np.array([[left, top], [right, top], [right, bottom], [left, bottom]], np.int32)
+    corners = geometry.calculate_rotated_corners()
+    return np.array([[int(corner.col), int(corner.row)] for corner in corners], np.int32)
+
+
+def draw_labels(
+    layer: np.ndarray,
+    labels: List[sly.Label],
+    thickness: Dict[type, int] = None,
+    default_thickness: int = 1,
+    contour: bool = False,
+):
+    """Same as calling label.draw (or label.draw_contour) for every label over the RGB layer, with
+    the thickness of its geometry type. Geometries with several colors (graphs, 2D cuboids) are
+    still drawn by the SDK, over the labels buffered before them."""
+    thickness = thickness or {}
+    # with labels drawn by the SDK in between, only the areas drawn before each of them are flushed
+    track_regions = any(type(label.geometry) not in _INDEXED for label in labels)
+    buffer = IndexBuffer(layer, track_regions)
+    for label in labels:
+        geometry = label.geometry
+        geometry_type = type(geometry)
+        label_thickness = thickness.get(geometry_type, default_thickness)
+        if geometry_type not in _INDEXED:
+            buffer.flush()
+            if contour:
+                label.draw_contour(layer, thickness=label_thickness)
+            else:
+                label.draw(layer, thickness=label_thickness)
+            continue
+
+        if track_regions:
+            buffer.mark(geometry.to_bbox(), label_thickness + 1)
+        color = label.obj_class.color
+        if contour and geometry_type in (sly.Rectangle, sly.OrientedBBox):
+            # cv2.rectangle outlines are closed polylines through the same corners
+            buffer.lines(_corners(geometry), True, color, label_thickness)
+        elif geometry_type == sly.Polyline:
+            points = geometry.exterior_np[:, ::-1].astype(np.int32)
+            buffer.lines(points, False, color, label_thickness)
+        elif contour:
+            buffer.draw(geometry._draw_contour_impl, buffer.color_index(color), label_thickness)
+        elif geometry_type == sly.Polygon:
+            buffer.draw(_fill_polygon, geometry, buffer.color_index(color))
+        else:
+            buffer.draw(geometry._draw_impl, buffer.color_index(color), label_thickness)
+    buffer.flush()
@@ -0,0 +1,105 @@
+import asyncio
+import multiprocessing
+import sys
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+
+from fastapi import HTTPException
+
+import src.metrics as metrics
+import supervisely as sly
+
+
+class RenderPool:
+    """Executor for rasterization and encoding.
+
+    The "thread" backend runs renders in a thread pool of the server process. The "process" backend
+    runs them in worker processes, so renders are not serialized by the GIL: workers receive the
+    annotation JSON, the parsed project meta and the settings and send back encoded bytes. Workers are
+    forked from a forkserver that has the app modules imported already, and the whole pool is replaced
+    after `max_tasks_per_worker` renders per worker to return memory fragmented by huge frames.
+
+    At most `queue_limit` renders wait or run at once, requests above that get 503 with Retry-After.
+    """
+
+    def __init__(
+        self,
+        backend: str = "thread",
+        workers: int = 4,
+        max_tasks_per_worker: int = 1000,
+        queue_limit: int = 256,
+        retry_after: int = 5,
+    ):
+        if backend not in ("thread", "process"):
+            raise ValueError(f"Unknown render backend '{backend}', use 'thread' or 'process'")
+        self.backend = backend
+        self.workers = workers
+        self.max_tasks = max_tasks_per_worker * workers
+        self.queue_limit = queue_limit
+        self.retry_after = retry_after
+        self._lock = threading.Lock()
+        self._executor = None
+        self._tasks = 0
+        self._queued = 0
+
+    def queued(self) -> int:
+        return self._queued
+
+    async def run(self, func, *args, **kwargs):
+        if self._queued >= self.queue_limit:
+            raise HTTPException(
+                status_code=503,
+                detail="Too many renders in progress, retry later",
+                headers={"Retry-After": str(self.retry_after)},
+            )
+        self._queued += 1
+        try:
+            with self._lock:
+                executor = self._get_executor()
+            loop = asyncio.get_running_loop()
+            try:
+                if self.backend == "thread":
+                    return await loop.run_in_executor(executor, partial(func, *args, **kwargs))
+                # metrics recorded in a worker process are sent back with the result
+                result, samples = await loop.run_in_executor(
+                    executor, partial(metrics.call_recorded, func, *args, **kwargs)
+                )
+                metrics.merge(samples)
+                return result
+            except BrokenProcessPool:
+                # a worker died (e.g. killed by the OOM killer), start a fresh pool for the next renders
+                sly.logger.warning("Render worker process died, restarting the pool")
+                with self._lock:
+                    if self._executor is executor:
+                        self._executor = None
+                raise
+        finally:
+            self._queued -= 1
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                if sys.version_info >= (3, 9):
+                    self._executor.shutdown(wait=False, cancel_futures=True)
+                else:
+                    # renders still queued run before the workers exit
+                    self._executor.shutdown(wait=False)
+                self._executor = None
+
+    def _get_executor(self):
+        if self.backend == "process":
+            self._tasks += 1
+            if self._executor is not None and self._tasks > self.max_tasks:
+                # running renders finish in the old workers, they exit afterwards
+                self._executor.shutdown(wait=False)
+                self._executor = None
+            if self._executor is None:
+                self._tasks = 1
+                context = multiprocessing.get_context("forkserver")
+                context.set_forkserver_preload(["src.utils"])
+                self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=context)
+        elif self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="render")
+        return self._executor
@@ -0,0 +1,388 @@
+import abc
+import bisect
+import hashlib
+import os
+import socket
+import threading
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+from urllib.parse import unquote, urlsplit
+
+import src.metrics as metrics
+import supervisely as sly
+
+
+class CacheBackend(abc.ABC):
+    """Byte values by string key on storage shared by the replicas of the app."""
+
+    @abc.abstractmethod
+    def get(self, key: str) -> Optional[bytes]:
+        pass
+
+    @abc.abstractmethod
+    def set(self, key: str, data: bytes, ttl: Optional[int] = None):
+        pass
+
+    def set_many(self, items: Iterable[Tuple[str, bytes]], ttl: Optional[int] = None):
+        for key, data in items:
+            self.set(key, data, ttl)
+
+    def exists(self, key: str) -> bool:
+        return self.get(key) is not None
+
+
+# the expiry line written before the value, a float of at most 24 characters
+HEADER_SIZE = 32
+
+
+class DirectoryBackend(CacheBackend):
+    """Files in a directory, e.g. a volume mounted into every pod. Entries older than their TTL and
+    entries that cannot be read are treated as missing and removed on read.
+
+    At most every `prune_interval` seconds a write starts a sweep in the background that removes the
+    expired entries and, above `max_size` bytes, the least recently used ones. Reads touch the files,
+    so their modification time is the time of the last use.
+    """
+
+    def __init__(self, path: str, max_size: Optional[int] = None, prune_interval: float = 600):
+        self.path = path
+        self.max_size = max_size
+        self.prune_interval = prune_interval
+        self._prune_lock = threading.Lock()
+        self._next_prune = time.monotonic()
+        os.makedirs(path, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        name = hashlib.sha256(key.encode("utf-8")).hexdigest()
+        return os.path.join(self.path, name[:2], name)
+
+    def _read(self, path: str) -> Tuple[float, bytes]:
+        with open(path, "rb") as file:
+            expires = float(file.readline())
+            return expires, file.read()
+
+    def _expires(self, path: str) -> float:
+        # only the header line, without reading the value
+        with open(path, "rb", buffering=0) as file:
+            header = file.read(HEADER_SIZE)
+        if b"\n" not in header:
+            raise ValueError(f"No header in {path}")
+        return float(header.split(b"\n", 1)[0])
+
+    def _remove(self, path: str):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def get(self, key: str) -> Optional[bytes]:
+        path = self._path(key)
+        try:
+            expires, data = self._read(path)
+            if expires != 0 and expires < time.time():
+                self._remove(path)
+                return None
+            os.utime(path)
+            return data
+        except FileNotFoundError:
+            return None
+        except ValueError:
+            # not written by this backend or damaged, the next set replaces it
+            sly.logger.warning(f"Removing unreadable shared cache entry {path}")
+            self._remove(path)
+            return None
+
+    def exists(self, key: str) -> bool:
+        path = self._path(key)
+        try:
+            expires = self._expires(path)
+        except FileNotFoundError:
+            return False
+        except ValueError:
+            self._remove(path)
+            return False
+        return expires == 0 or expires >= time.time()
+
+    def set(self, key: str, data: bytes, ttl: Optional[int] = None):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        expires = 0 if ttl is None else time.time() + ttl
+        # unique per host and thread, several pods may write the same key at once
+        tmp_path = f"{path}.{socket.gethostname()}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as file:
+            file.write(f"{expires}\n".encode("ascii"))
+            file.write(data)
+        os.replace(tmp_path, path)
+        self._prune_in_background()
+
+    def prune(self):
+        """Removes expired and unreadable entries, temporary files left by writers that died and the
+        least recently used entries while the directory holds more than `max_size` bytes."""
+        now = time.time()
+        entries, total = [], 0
+        for root, _, names in os.walk(self.path):
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                    if name.endswith(".tmp"):
+                        if stat.st_mtime < now - self.prune_interval:
+                            self._remove(path)
+                        continue
+                    expires = self._expires(path)
+                except FileNotFoundError:
+                    continue
+                except ValueError:
+                    self._remove(path)
+                    continue
+                if expires != 0 and expires < now:
+                    self._remove(path)
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+                total += stat.st_size
+        if self.max_size is None or total <= self.max_size:
+            return
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_size:
+                break
+            self._remove(path)
+            total -= size
+
+    def _prune_in_background(self):
+        if time.monotonic() < self._next_prune or not self._prune_lock.acquire(blocking=False):
+            return
+        self._next_prune = time.monotonic() + self.prune_interval
+
+        def _prune():
+            try:
+                self.prune()
+            except OSError as e:
+                sly.logger.warning(f"Failed to prune the shared cache directory {self.path}: {repr(e)}")
+            finally:
+                self._prune_lock.release()
+
+        threading.Thread(target=_prune, name="shared-cache-prune", daemon=True).start()
+
+
+class RedisError(Exception):
+    pass
+
+
+class _Connection:
+    def __init__(self, host: str, port: int, timeout: float):
+        self.sock = socket.create_connection((host, port), timeout=timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.file = self.sock.makefile("rb")
+
+    def send(self, commands: List[tuple]):
+        chunks = []
+        for command in commands:
+            chunks.append(b"*%d\r\n" % len(command))
+            for arg in command:
+                if not isinstance(arg, bytes):
+                    arg = str(arg).encode("utf-8")
+                chunks.append(b"$%d\r\n%s\r\n" % (len(arg), arg))
+        self.sock.sendall(b"".join(chunks))
+
+    def read(self):
+        line = self.file.readline()
+        if not line.endswith(b"\r\n"):
+            raise ConnectionError("Connection closed by the server")
+        prefix, value = line[:1], line[1:-2]
+        if prefix == b"+":
+            return value
+        if prefix == b"-":
+            raise RedisError(value.decode("utf-8", "replace"))
+        if prefix == b":":
+            return int(value)
+        if prefix == b"$":
+            length = int(value)
+            if length == -1:
+                return None
+            data = self.file.read(length + 2)
+            if len(data) != length + 2:
+                raise ConnectionError("Connection closed by the server")
+            return data[:-2]
+        if prefix == b"*":
+            length = int(value)
+            return None if length == -1 else [self.read() for _ in range(length)]
+        raise RedisError(f"Unexpected reply: {line!r}")
+
+    def close(self):
+        try:
+            self.file.close()
+            self.sock.close()
+        except OSError:
+            pass
+
+
+class RedisBackend(CacheBackend):
+    """Any server speaking the Redis protocol, `redis://[:password@]host[:port][/db]`. Keeps a pool
+    of up to `pool_size` idle connections, commands of set_many are pipelined. Set a memory limit
+    with an LRU eviction policy on the server (maxmemory, maxmemory-policy allkeys-lru)."""
+
+    def __init__(self, url: str, timeout: float = 1.0, pool_size: int = 16):
+        parts = urlsplit(url)
+        self.url = url
+        self.host = parts.hostname or "localhost"
+        self.port = parts.port or 6379
+        self.password = unquote(parts.password) if parts.password else None
+        self.db = int(parts.path.strip("/") or 0)
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self._lock = threading.Lock()
+        self._idle = []
+
+    def _connect(self) -> _Connection:
+        connection = _Connection(self.host, self.port, self.timeout)
+        try:
+            setup = []
+            if self.password is not None:
+                setup.append(("AUTH", self.password))
+            if self.db != 0:
+                setup.append(("SELECT", self.db))
+            if len(setup) > 0:
+                connection.send(setup)
+                for _ in setup:
+                    connection.read()
+        except Exception:
+            connection.close()
+            raise
+        return connection
+
+    def execute(self, *commands: tuple) -> list:
+        """Sends the commands in one round trip, returns their replies."""
+        with self._lock:
+            connection = self._idle.pop() if len(self._idle) > 0 else None
+        if connection is None:
+            connection = self._connect()
+        try:
+            connection.send(commands)
+            replies = [connection.read() for _ in commands]
+        except (OSError, ConnectionError, RedisError):
+            # after an error reply the replies to the following commands are still unread
+            connection.close()
+            raise
+        with self._lock:
+            if len(self._idle) < self.pool_size:
+                self._idle.append(connection)
+                connection = None
+        if connection is not None:
+            connection.close()
+        return replies
+
+    def get(self, key: str) -> Optional[bytes]:
+        return self.execute(("GET", key))[0]
+
+    def set(self, key: str, data: bytes, ttl: Optional[int] = None):
+        self.execute(self._set_command(key, data, ttl))
+
+    def set_many(self, items: Iterable[Tuple[str, bytes]], ttl: Optional[int] = None):
+        commands = [self._set_command(key, data, ttl) for key, data in items]
+        if len(commands) > 0:
+            self.execute(*commands)
+
+    def exists(self, key: str) -> bool:
+        return self.execute(("EXISTS", key))[0] == 1
+
+    def _set_command(self, key: str, data: bytes, ttl: Optional[int]) -> tuple:
+        if ttl is None:
+            return ("SET", key, data)
+        return ("SET", key, data, "EX", ttl)
+
+
+def create_backend(url: str, directory_size: Optional[int] = None) -> CacheBackend:
+    """redis:// URLs are Redis servers, file:// URLs and plain paths are directories of at most
+    `directory_size` bytes."""
+    scheme = urlsplit(url).scheme
+    if scheme == "redis":
+        return RedisBackend(url)
+    if scheme == "file":
+        return DirectoryBackend(unquote(urlsplit(url).path), max_size=directory_size)
+    if scheme == "":
+        return DirectoryBackend(url, max_size=directory_size)
+    raise ValueError(f"Unsupported shared cache URL: {url}")
+
+
+def _redacted(url: str) -> str:
+    parts = urlsplit(url)
+    if parts.password is None:
+        return url
+    return parts._replace(netloc=parts.netloc.rsplit("@", 1)[1]).geturl()
+
+
+def _hash(value: str) -> int:
+    return int.from_bytes(hashlib.md5(value.encode("utf-8")).digest()[:8], "big")
+
+
+class HashRing:
+    """Consistent hashing of keys to nodes. Every node has `points` positions on the ring and owns the
+    keys that hash right before them, so adding or removing one of N nodes moves only about 1/N of
+    the keys. The hash does not depend on the process, every replica maps a key to the same node."""
+
+    def __init__(self, nodes: List[str], points: int = 160):
+        if len(nodes) == 0:
+            raise ValueError("Hash ring needs at least one node")
+        ring = sorted((_hash(f"{node}#{i}"), node) for node in nodes for i in range(points))
+        self._hashes = [position for position, _ in ring]
+        self._nodes = [node for _, node in ring]
+
+    def node(self, key: str) -> str:
+        index = bisect.bisect(self._hashes, _hash(key)) % len(self._hashes)
+        return self._nodes[index]
+
+
+class SharedCache:
+    """Cache shared by all replicas over one or more backend nodes, every key is stored on the node
+    that owns it on a HashRing. With a node per replica the cache grows with the replicas while every
+    replica still finds the entries the others have stored.
+
+    The shared cache is an optimization: a node that fails is logged, skipped for `retry_interval`
+    seconds and its keys are treated as missing meanwhile.
+    """
+
+    def __init__(
+        self,
+        urls: List[str],
+        ttl: Optional[int] = None,
+        retry_interval: float = 10,
+        directory_size: Optional[int] = None,
+    ):
+        self.ttl = ttl
+        self.retry_interval = retry_interval
+        self._backends: Dict[str, CacheBackend] = {
+            url: create_backend(url, directory_size) for url in urls
+        }
+        self._ring = HashRing(urls)
+        self._down_until = {}  # url -> monotonic time
+
+    def get(self, key: str) -> Optional[bytes]:
+        data = self._call(key, "get", key)
+        metrics.inc("shared_cache_requests_total", result="miss" if data is None else "hit")
+        return data
+
+    def put(self, key: str, data: bytes):
+        self._call(key, "set", key, data, self.ttl)
+
+    def put_many(self, items: Iterable[Tuple[str, bytes]]):
+        by_node = {}
+        for key, data in items:
+            by_node.setdefault(self._ring.node(key), []).append((key, data))
+        for node, node_items in by_node.items():
+            self._call(node_items[0][0], "set_many", node_items, self.ttl)
+
+    def __contains__(self, key: str) -> bool:
+        return bool(self._call(key, "exists", key))
+
+    def _call(self, key: str, method: str, *args):
+        url = self._ring.node(key)
+        if self._down_until.get(url, 0) > time.monotonic():
+            return None
+        try:
+            return getattr(self._backends[url], method)(*args)
+        except (OSError, ConnectionError, RedisError, ValueError) as e:
+            self._down_until[url] = time.monotonic() + self.retry_interval
+            metrics.inc("shared_cache_requests_total", result="error")
+            sly.logger.warning(f"Shared cache node {_redacted(url)} failed, skipping it: {repr(e)}")
+            return None
@@ -0,0 +1,44 @@
+import asyncio
+from typing import Awaitable, Callable, Hashable
+
+from fastapi import HTTPException
+
+
+class SingleFlight:
+    """Coalesces concurrent identical computations: the first call with a key starts the computation,
+    calls with the same key made before it finishes await the same result (or exception) instead of
+    starting their own.
+
+    Every caller waits at most `timeout` seconds and gets 503 with Retry-After after that. The
+    computation itself is not cancelled by timeouts or disconnected clients, it still finishes and
+    fills the render cache for the retry.
+    """
+
+    def __init__(self, timeout: float = 60, retry_after: int = 5):
+        self.timeout = timeout
+        self.retry_after = retry_after
+        self._flights = {}  # key -> asyncio.Future
+
+    async def run(self, key: Hashable, func: Callable[[], Awaitable]):
+        future = self._flights.get(key)
+        if future is None:
+            future = asyncio.ensure_future(func())
+            self._flights[key] = future
+            future.add_done_callback(lambda done: self._finish(key, done))
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), self.timeout)
+        except asyncio.TimeoutError:
+            raise HTTPException(
+                status_code=503,
+                detail="The render is taking too long, retry later",
+                headers={"Retry-After": str(self.retry_after)},
+            )
+
+    def in_flight(self) -> int:
+        return len(self._flights)
+
+    def _finish(self, key: Hashable, future: asyncio.Future):
+        if self._flights.get(key) is future:
+            del self._flights[key]
+        if not future.cancelled():
+            future.exception()  # retrieved, even if all the callers have timed out
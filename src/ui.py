@@ -11,10 +11,12 @@ import supervisely as sly
 from supervisely.app.widgets import (
     Button,
     Card,
+    Checkbox,
     Container,
     Editor,
     Empty,
     Image,
+    SelectDataset,
     SelectItem,
     Text,
 )
@@ -26,6 +28,10 @@ settings_dict = {
     "MASK_OPACITY": 0.7,
     "RENDER_HEATMAPS": True,
     "HEATMAP_THRESHOLD": 0.2,
+    "OUTPUT_FORMAT": "auto",
+    "PNG_COMPRESSION": None,
+    "WEBP_QUALITY": 90,
+    "WEBP_LOSSLESS": True,
 }
 settings_dict_renders_on_image = {
     "OUTPUT_WIDTH_PX": 500,
@@ -34,6 +40,12 @@ settings_dict_renders_on_image = {
     "MASK_OPACITY": 0.7,
     "RENDER_HEATMAPS": True,
     "HEATMAP_THRESHOLD": 0.2,
+    "OUTPUT_FORMAT": "auto",
+    "PNG_COMPRESSION": None,
+    "WEBP_QUALITY": 90,
+    "WEBP_LOSSLESS": False,
+    "JPEG_QUALITY": 90,
+    "MAX_SIDE_PX": 2048,
 }
 editor = Editor(initial_text=json.dumps(settings_dict, indent=4))
 
@@ -63,6 +75,29 @@ card_1 = Card(
 
 infotext.hide()
 
+select_datasets = SelectDataset(multiselect=True, select_all_datasets=True)
+checkbox_figures = Checkbox("Also render every figure separately")
+button_prerender = Button(text="Start pre-rendering")
+button_stop = Button(text="Stop", button_type="danger")
+prerender_text = Text()
+
+card_2 = Card(
+    title="Pre-render",
+    description="Render whole datasets into the cache in the background",
+    content=Container(
+        widgets=[
+            select_datasets,
+            checkbox_figures,
+            Container(
+                [button_prerender, button_stop, Empty()],
+                "horizontal",
+                fractions=[1, 1, 8],
+            ),
+            prerender_text,
+        ]
+    ),
+)
+
 
 def get_settings(endpoint_name="renders") -> dict:
     if endpoint_name == "render-on-image":
@@ -87,9 +122,8 @@ def preview() -> None:
 
     proj_id = g.api.image.get_project_id(select_item.get_selected_id())
 
-    # project = g.api.project.get_info_by_id(proj_id)
-    project_meta = sly.ProjectMeta.from_json(g.api.project.get_meta(proj_id))
-    # project_meta = g.JSON_METAS[proj_id]
+    project = g.api.project.get_info_by_id(proj_id)
+    _, project_meta = g.meta_cache.get(proj_id, project.updated_at)
 
     image = g.api.image.get_info_by_id(item_id)
     jann = g.api.annotation.download_json(item_id)
@@ -129,3 +163,43 @@ def preview() -> None:
         img_orig.set(url=f"static/resizedorigs/{image.id}.png")
         img_mask.set(url=f"static/renders/{image.id}.png")
         img_overlap.set(url=f"static/overlaps/{image.id}.png")
+
+
+def show_prerender_status(status: dict) -> None:
+    if status["status"] == "idle":
+        prerender_text.hide()
+        return
+    done = status["rendered"] + status["skipped"] + status["failed"]
+    text = (
+        f"{status['status'].capitalize()}: {done} / {status['total']} images "
+        f"(rendered {status['rendered']}, already cached {status['skipped']}, failed {status['failed']})"
+    )
+    if status["error"] is not None:
+        text += f". Error: {status['error']}"
+    text_status = {"running": "info", "finished": "success", "failed": "error"}
+    prerender_text.set(text, text_status.get(status["status"], "warning"))
+    prerender_text.show()
+
+
+@button_prerender.click
+def start_prerender() -> None:
+    import src.prerender as prerender
+
+    try:
+        status = prerender.job.start(
+            select_datasets.get_selected_project_id(),
+            select_datasets.get_selected_ids(),
+            figures=checkbox_figures.is_checked(),
+        )
+    except Exception as e:
+        prerender_text.set(f"Error: {e}", "error")
+        prerender_text.show()
+        return
+    show_prerender_status(status)
+
+
+@button_stop.click
+def stop_prerender() -> None:
+    import src.prerender as prerender
+
+    show_prerender_status(prerender.job.stop())
@@ -1,77 +1,190 @@
-import os
+import io
+import json
+import math
 import re
+import time
+import zipfile
+from collections import Counter
 
 import cv2
 import numpy as np
 import requests
 from fastapi import FastAPI, HTTPException, Response
+from starlette.concurrency import run_in_threadpool
 from starlette.responses import StreamingResponse
 
+import src.encoders as encoders
 import src.globals as g
+import src.metrics as metrics
+import src.rasterizer as rasterizer
 import supervisely as sly
+from src.compositor import Compositor
 from src.ui import get_settings
 from supervisely import ImageInfo, ProjectInfo
 from supervisely.annotation.tag import TagJsonFields
-from supervisely.geometry.bitmap import Bitmap
 from supervisely.geometry.cuboid import Cuboid
-from supervisely.geometry.polygon import Polygon
-from supervisely.geometry.rectangle import Rectangle
 from supervisely.imaging.color import _validate_hex_color, hex2rgb, random_rgb, rgb2hex
 
 
-def get_thickness(render: np.ndarray, thickness_percent: float, from_min=False) -> int:
-    render_height, render_width, _ = render.shape
+def get_thickness(render_size, thickness_percent: float, from_min=False) -> int:
+    render_height, render_width = render_size[:2]
     render_side = render_width
     if from_min:
         render_side = min(render_height, render_width)
-    return int(render_side * thickness_percent / 100)
+    # OpenCV rejects zero thickness, tiny renders still get hairlines
+    return max(int(render_side * thickness_percent / 100), 1)
 
 
-def get_rendered_image(image_id, project_id, json_project_meta, figure_id=None):
+async def run_io(func, *args, **kwargs):
+    # blocking SDK calls and disk access go to the starlette threadpool
+    call = getattr(func, "__qualname__", str(func))
+    metrics.inc("io_calls_total", call=call)
+    start = time.perf_counter()
     try:
-        project_meta = sly.ProjectMeta.from_json(json_project_meta)
-    except Exception as e:  # Error: Supported only HEX RGB string format!
-        json_project_meta = handle_broken_project_meta(json_project_meta)
-        project_meta = sly.ProjectMeta.from_json(json_project_meta)
+        return await run_in_threadpool(func, *args, **kwargs)
+    finally:
+        metrics.observe("io_seconds", time.perf_counter() - start, call=call)
 
+
+async def run_cpu(func, *args, **kwargs):
+    # rasterization and encoding go to the render pool (threads or worker processes)
+    return await g.render_pool.run(func, *args, **kwargs)
+
+
+def download_ann_json(image_id: int) -> dict:
     try:
-        jann = g.api.annotation.download_json(image_id)
+        return g.api.annotation.download_json(image_id)
     except requests.exceptions.HTTPError as e:
         sly.logger.error(str(e))  # image not accessed
         raise HTTPException(status_code=404, detail=str(e))
 
-    try:
-        try:
-            ann = sly.Annotation.from_json(jann, project_meta)
-        except ValueError as e:  # Tag Meta is none
-            json_project_meta = g.api.project.get_meta(project_id)
-            g.JSON_METAS[project_id] = json_project_meta
-            project_meta = sly.ProjectMeta.from_json(json_project_meta)
-            jann = g.api.annotation.download_json(image_id)
-            ann = sly.Annotation.from_json(jann, project_meta)
-        # except KeyError as e:  # missing fields in api response
-        #     if e.args[0].value in TagJsonFields.values():
-        #         tmp = jann.copy()
-        #         tmp["tags"] = []
-        #         ann = sly.Annotation.from_json(tmp, project_meta)
-
-    except RuntimeError:
-        # case 1: new class added to image, but meta is old
-        json_project_meta = g.api.project.get_meta(project_id)
-        g.JSON_METAS[project_id] = json_project_meta
-        project_meta = sly.ProjectMeta.from_json(json_project_meta)
+
+def get_image_infos(image_ids: list) -> dict:
+    """Infos of the listed images by ID, like api.image.get_info_by_id_batch but images that are
+    missing or not accessible are left out instead of failing the whole batch. Images of one dataset
+    are listed in one request."""
+    infos = {}
+    remaining = list(dict.fromkeys(image_ids))
+    while len(remaining) > 0:
+        image_id = remaining.pop(0)
+        info = g.api.image.get_info_by_id(image_id, force_metadata_for_links=False)
+        if info is None:
+            continue
+        filters = [{"field": "id", "operator": "in", "value": [image_id, *remaining]}]
+        for image in g.api.image.get_list(info.dataset_id, filters=filters):
+            infos[image.id] = image
+        infos.setdefault(image_id, info)
+        remaining = [i for i in remaining if i not in infos]
+    return infos
+
+
+def parse_annotation(image_id, project_id, project_meta: sly.ProjectMeta, jann=None) -> sly.Annotation:
+    if jann is None:
+        jann = download_ann_json(image_id)
+
+    with metrics.timer("annotation_parse"):
         try:
             ann = sly.Annotation.from_json(jann, project_meta)
-        except (RuntimeError, ValueError):
-            # case 2: broken annotations
-            jann["objects"] = handle_broken_annotations(jann, json_project_meta)
-            ann = sly.Annotation.from_json(jann, project_meta)
+        except (RuntimeError, ValueError, KeyError, TypeError):
+            # the meta is always the one of the current project version, the annotation is broken
+            ann = repair_annotation(jann, project_meta, image_id)
 
     if any([True for val in ann.img_size if val is None]):
         raise HTTPException(
             status_code=500,
             detail="The image file has no information about its size. Please check the integrity of your project.",
         )
+    return ann
+
+
+def _known_tags(tags: list, project_meta: sly.ProjectMeta) -> list:
+    known = []
+    for tag in tags or []:
+        name = tag if isinstance(tag, str) else tag.get(TagJsonFields.TAG_NAME)
+        if project_meta.get_tag_meta(name) is not None:
+            known.append(tag)
+    return known
+
+
+# checked before parsing, the SDK only logs a warning for polygons with less than 3 points
+_MIN_POINTS = {sly.Polygon.geometry_name(): 3, sly.Rectangle.geometry_name(): 2}
+
+
+def repair_annotation(jann: dict, project_meta: sly.ProjectMeta, image_id=None) -> sly.Annotation:
+    """Annotation.from_json that drops what can not be parsed instead of failing: objects of classes
+    missing in the meta, legacy 3D cuboids, broken geometries (empty bitmaps, polygons with less than
+    3 points, geometries not matching the class shape) and tags of unknown tag metas. One pass over
+    the downloaded JSON, every object is decoded once."""
+    labels, dropped = [], Counter()
+    for obj in jann.get("objects", []):
+        if obj.get("geometryType") == Cuboid.geometry_name():
+            dropped["cuboid"] += 1
+            continue
+        if project_meta.get_obj_class(obj.get("classTitle")) is None:
+            dropped["unknown_class"] += 1
+            continue
+        min_points = _MIN_POINTS.get(obj.get("geometryType"))
+        if min_points is not None and len(obj.get("points", {}).get("exterior", [])) < min_points:
+            dropped["broken_geometry"] += 1
+            continue
+        if len(obj.get("tags") or []) > 0:
+            obj = {**obj, "tags": _known_tags(obj["tags"], project_meta)}
+        try:
+            labels.append(sly.Label.from_json(obj, project_meta))
+        except Exception:
+            dropped["broken_geometry"] += 1
+
+    img_tags = _known_tags(jann.get("tags"), project_meta)
+    ann = sly.Annotation.from_json({**jann, "objects": [], "tags": img_tags}, project_meta)
+    ann = ann.clone(labels=labels)
+
+    metrics.inc("repairs_total", kind="annotation")
+    for reason, count in dropped.items():
+        metrics.inc("dropped_objects_total", count, reason=reason)
+    dropped_tags = len(jann.get("tags") or []) - len(img_tags)
+    sly.logger.warning(
+        f"Broken annotation of image {image_id} repaired: dropped objects {dict(dropped)}, "
+        f"dropped image tags: {dropped_tags}"
+    )
+    return ann
+
+
+async def load_annotation(
+    project: ProjectInfo, image: ImageInfo, project_meta: sly.ProjectMeta
+) -> dict:
+    """Annotation of the image as the keyword argument of the render functions. For render threads
+    `ann`: parsed, from the annotation cache, downloaded and parsed on a miss, concurrent misses for
+    one image share the download. For worker processes `jann`: the JSON, parsed in the worker, a
+    parsed annotation with decoded bitmaps would be pickled to the worker on every render."""
+    if g.render_pool.backend == "process":
+        return {"jann": await run_io(download_ann_json, image.id)}
+
+    key = (image.id, image.updated_at, project.updated_at)
+    ann = g.ann_cache.get(key)
+    if ann is not None:
+        return {"ann": ann}
+
+    async def _load():
+        jann = await run_io(download_ann_json, image.id)
+        ann = await run_cpu(parse_annotation, image.id, project.id, project_meta, jann)
+        g.ann_cache.put(key, ann)
+        return ann
+
+    return {"ann": await g.single_flight.run(("annotation", *key), _load)}
+
+
+def get_rendered_image(
+    image_id,
+    project_id,
+    project_meta: sly.ProjectMeta,
+    figure_id=None,
+    jann=None,
+    output_format="png",
+    settings: dict = None,
+    ann: sly.Annotation = None,
+) -> bytes:
+    if ann is None:
+        ann = parse_annotation(image_id, project_id, project_meta, jann)
 
     if figure_id is not None:
         new_labels = [label for label in ann.labels if label.sly_id == figure_id]
@@ -82,7 +195,7 @@ def get_rendered_image(image_id, project_id, json_project_meta, figure_id=None):
             )
         ann = ann.clone(labels=new_labels)
 
-    settings = get_settings()
+    settings = settings or get_settings()
     rgba, _, _ = get_rgba_np(
         ann,
         settings.get("OUTPUT_WIDTH_PX", 500),
@@ -96,21 +209,552 @@ def get_rendered_image(image_id, project_id, json_project_meta, figure_id=None):
         heatmap_threshold=settings.get("HEATMAP_THRESHOLD", 0.2),
     )
 
-    rgba = cv2.cvtColor(rgba.astype("uint8"), cv2.COLOR_RGBA2BGRA)
-    return cv2.imencode(".png", rgba)
+    with metrics.timer("encode"):
+        rgba = cv2.cvtColor(rgba.astype("uint8"), cv2.COLOR_RGBA2BGRA)
+        return encoders.encode(rgba, output_format, settings)
 
-def color_map(img_size, data: np.ndarray, origin: sly.PointLocation, threshold: float) -> np.ndarray:
-    mask = np.zeros(img_size, dtype=np.uint8)
+
+def stroke_padding(reference_size, settings: dict) -> int:
+    """Pixels a drawn label can reach beyond its bounds: point radius, line and bbox contour strokes."""
+    return (
+        get_thickness(reference_size, 3, from_min=True)
+        + get_thickness(reference_size, settings.get("BBOX_THICKNESS_PERCENT", 0.5))
+        + 2
+    )
+
+
+def uncropped_annotation(img_size, labels: list) -> sly.Annotation:
+    # sly.Annotation crops labels to its canvas: cut shapes would get contours along the edges and
+    # graphs would lose nodes, here the drawing clips them instead
+    ann = sly.Annotation(img_size)
+    ann._labels.extend(labels)
+    return ann
+
+
+def crop_annotation(
+    ann: sly.Annotation, top: int, left: int, height: int, width: int, pad: int = 0
+) -> sly.Annotation:
+    """Labels of the window moved to its coordinates. Labels farther than `pad` pixels from the window
+    are dropped, bitmaps are cropped to the window and the rest are kept whole, so the drawing clips
+    them at the window and no outline appears along its edges (heatmaps are normalized over the
+    whole mask)."""
+    window = sly.Rectangle(top, left, top + height - 1, left + width - 1)
+    padded = sly.Rectangle(top - pad, left - pad, top + height - 1 + pad, left + width - 1 + pad)
+    labels = []
+    for label in ann.labels:
+        if type(label.geometry) == sly.Bitmap:
+            if label.geometry.to_bbox().intersects_with(window):
+                labels.extend(cropped.translate(-top, -left) for cropped in label.crop(window))
+        elif label.geometry.to_bbox().intersects_with(padded):
+            labels.append(label.translate(-top, -left))
+    return uncropped_annotation((height, width), labels)
+
+
+def get_rendered_tile(
+    image_id,
+    project_id,
+    project_meta: sly.ProjectMeta,
+    top: int,
+    left: int,
+    height: int,
+    width: int,
+    zoom: int = 0,
+    jann=None,
+    output_format="png",
+    settings: dict = None,
+    ann: sly.Annotation = None,
+) -> bytes:
+    """Render the (top, left, height, width) window of the image annotation downscaled 2^zoom times.
+    The tile matches that window of the whole image rendered at 1/2^zoom of its size: labels are
+    resized to the whole image, line thickness and heatmap colors are relative to it too. Lines and
+    polygon edges crossing the tile border may be a pixel off, OpenCV rasterizes them from the
+    clipped end points. Bitmaps and alpha masks are sampled at the pixels of the tile only, memory
+    does not grow with the size of the image."""
+    if ann is None:
+        ann = parse_annotation(image_id, project_id, project_meta, jann)
+    settings = settings or get_settings()
+    scale = 2**zoom
+    frame_size = (math.ceil(ann.img_size[0] / scale), math.ceil(ann.img_size[1] / scale))
+    reference_size = (ann.img_size[0] / scale, ann.img_size[1] / scale)
+    pad = stroke_padding(reference_size, settings)
+    threshold = settings.get("HEATMAP_THRESHOLD", 0.2)
+
+    # only the labels near the window are resized, the rest would be dropped anyway
+    margin = pad * scale
+    near = sly.Rectangle(
+        top - margin, left - margin, top + height - 1 + margin, left + width - 1 + margin
+    )
+    top, left = top // scale, left // scale
+    height, width = max(math.ceil(height / scale), 1), max(math.ceil(width / scale), 1)
+    padded = sly.Rectangle(top - pad, left - pad, top + height - 1 + pad, left + width - 1 + pad)
+    labels, heatmap_ranges = [], {}
+    for label in ann.labels:
+        value_range = None
+        if isinstance(label.geometry, sly.Bitmap):
+            # rasters are sampled at the pixels of the tile only, never resized whole
+            sampled = sample_raster(label, ann.img_size, frame_size, (top, left, height, width))
+            if sampled is None:
+                continue
+            if type(label.geometry) == sly.AlphaMask:
+                value_range = heatmap_range(label.geometry, *sampled[1:], frame_size, threshold)
+            label = sampled[0]
+        else:
+            # the rest are kept whole, the drawing clips them (see crop_annotation)
+            if not label.geometry.to_bbox().intersects_with(near):
+                continue
+            if zoom > 0:
+                label = label.resize(ann.img_size, frame_size)
+            if not label.geometry.to_bbox().intersects_with(padded):
+                continue
+        labels.append(label.translate(-top, -left))
+        if value_range is not None:
+            heatmap_ranges[id(labels[-1])] = value_range
+    tile = uncropped_annotation((height, width), labels)
+
+    rgba, _, _ = get_rgba_np(
+        tile,
+        tile.img_size[1],
+        settings.get("BBOX_THICKNESS_PERCENT", 0.5),
+        settings.get("BBOX_OPACITY", 1),
+        settings.get("FILLBBOX_OPACITY", 0.2),
+        settings.get("MASK_OPACITY", 0.7),
+        project_id,
+        image_id,
+        skip_resize=True,
+        render_heatmap=settings.get("RENDER_HEATMAPS", False),
+        heatmap_threshold=threshold,
+        reference_size=reference_size,
+        heatmap_ranges=heatmap_ranges,
+    )
+
+    with metrics.timer("encode"):
+        rgba = cv2.cvtColor(rgba.astype("uint8"), cv2.COLOR_RGBA2BGRA)
+        return encoders.encode(rgba, output_format, settings)
+
+
+def pack_sprites(sizes: list, sprite_width: int):
+    """Shelf packing of (height, width) rectangles into rows of sprite_width, tallest first.
+    Returns the (y, x) position of every rectangle and the sprite height."""
+    positions = [None] * len(sizes)
+    x, y, shelf_height = 0, 0, 0
+    for index in sorted(range(len(sizes)), key=lambda i: -sizes[i][0]):
+        height, width = sizes[index]
+        if x + width > sprite_width:
+            x, y, shelf_height = 0, y + shelf_height, 0
+        positions[index] = (y, x)
+        x += width
+        shelf_height = max(shelf_height, height)
+    return positions, y + shelf_height
+
+
+def get_rendered_figures(
+    image_id: int,
+    project_id: int,
+    project_meta: sly.ProjectMeta,
+    figure_ids: list = None,
+    jann=None,
+    output_format="png",
+    settings: dict = None,
+    ann: sly.Annotation = None,
+) -> bytes:
+    """Single figure renders of the image (all figures or figure_ids) packed into one sprite sheet.
+    Every figure is rendered as /renders?figure_id would, but only within its bounds. Returns a zip
+    archive with the sprite and index.json: the size of the /renders frame, the rectangle of every
+    figure in the sprite (x, y, width, height) and its offset in the frame (top, left)."""
+    if ann is None:
+        ann = parse_annotation(image_id, project_id, project_meta, jann)
+    settings = settings or get_settings()
+    width = settings.get("OUTPUT_WIDTH_PX", 500)
+    out_size = thumbnail_size(ann.img_size, width)
+    wanted = None if figure_ids is None else set(figure_ids)
+
+    # labels lose their IDs on resize, keep them alongside
+    with metrics.timer("resize"):
+        figures = []
+        for label in ann.labels:
+            if wanted is not None and label.sly_id not in wanted:
+                continue
+            try:
+                figures.append((label.sly_id, resize_label(label, ann.img_size, out_size)))
+            except ValueError:  # empty mask after resizing
+                pass
+    frame = ann.clone(img_size=out_size, labels=[])
+
+    pad = stroke_padding(out_size, settings)
+    crops, index = [], []
+    for figure_id, label in figures:
+        bbox = label.geometry.to_bbox()
+        top, left = max(bbox.top - pad, 0), max(bbox.left - pad, 0)
+        bottom = min(bbox.bottom + pad, out_size[0] - 1)
+        right = min(bbox.right + pad, out_size[1] - 1)
+        if bottom < top or right < left:
+            continue
+        crop_height, crop_width = bottom - top + 1, right - left + 1
+        tile = crop_annotation(frame.clone(labels=[label]), top, left, crop_height, crop_width)
+        rgba, _, _ = get_rgba_np(
+            tile,
+            crop_width,
+            settings.get("BBOX_THICKNESS_PERCENT", 0.5),
+            settings.get("BBOX_OPACITY", 1),
+            settings.get("FILLBBOX_OPACITY", 0.2),
+            settings.get("MASK_OPACITY", 0.7),
+            project_id,
+            image_id,
+            skip_resize=True,
+            render_heatmap=settings.get("RENDER_HEATMAPS", False),
+            heatmap_threshold=settings.get("HEATMAP_THRESHOLD", 0.2),
+            reference_size=out_size,
+        )
+        crops.append(rgba)
+        index.append(
+            {"id": figure_id, "width": crop_width, "height": crop_height, "top": top, "left": left}
+        )
+
+    positions, sprite_height = pack_sprites([rgba.shape[:2] for rgba in crops], out_size[1])
+    sprite = np.zeros((max(sprite_height, 1), out_size[1], 4), dtype=np.uint8)
+    for rgba, (y, x), entry in zip(crops, positions, index):
+        sprite[y : y + rgba.shape[0], x : x + rgba.shape[1]] = rgba
+        entry["x"], entry["y"] = x, y
+
+    rendered = {entry["id"] for entry in index}
+    missing = [] if figure_ids is None else [i for i in figure_ids if i not in rendered]
+    with metrics.timer("encode"):
+        bgra = cv2.cvtColor(sprite, cv2.COLOR_RGBA2BGRA)
+        content = encoders.encode(bgra, output_format, settings)
+    index = {
+        "frame": {"width": out_size[1], "height": out_size[0]},
+        "figures": index,
+        "missing": missing,
+    }
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", compression=zipfile.ZIP_STORED) as archive:
+        archive.writestr(f"sprite{encoders.extension(output_format)}", content)
+        archive.writestr("index.json", json.dumps(index, indent=4))
+    return buffer.getvalue()
+
+
+def get_rendered_on_image(
+    jann: dict,
+    project_meta: sly.ProjectMeta,
+    project_id: int,
+    image_id: int,
+    draw_class_names: bool,
+    draw_tags: bool,
+    with_image: bool,
+    np_image,
+    output_format="png",
+    output_width: int = None,
+    settings: dict = None,
+) -> bytes:
+    ann = parse_annotation(image_id, project_id, project_meta, jann)
+
+    skip_resize = output_width is None
+    if not skip_resize and np_image is not None:
+        out_size = thumbnail_size(ann.img_size, output_width)
+        if np_image.shape[:2] != out_size:
+            np_image = cv2.resize(np_image, (out_size[1], out_size[0]), interpolation=cv2.INTER_AREA)
+
+    settings = settings or get_settings("render-on-image")
+    rgba, _, _ = get_rgba_np(
+        ann,
+        output_width,
+        settings.get("BBOX_THICKNESS_PERCENT", 0.5),
+        settings.get("BBOX_OPACITY", 1),
+        settings.get("FILLBBOX_OPACITY", 0.2),
+        settings.get("MASK_OPACITY", 0.7),
+        project_id,
+        image_id,
+        draw_class_names,
+        draw_tags,
+        with_image,
+        np_image,
+        skip_resize=skip_resize,
+        render_heatmap=settings.get("RENDER_HEATMAPS", False),
+        heatmap_threshold=settings.get("HEATMAP_THRESHOLD", 0.2),
+    )
+
+    with metrics.timer("encode"):
+        rgba = cv2.cvtColor(rgba.astype("uint8"), cv2.COLOR_RGBA2BGRA)
+        return encoders.encode(rgba, output_format, settings)
+
+
+def get_output_size(img_size, width: int = None, max_side: int = None):
+    """(height, width) to render an image of img_size at, or None for the full resolution.
+    Uses the same proportions as the thumbnails of get_rgba_np and never upscales."""
+    img_height, img_width = img_size
+    if img_height is None or img_width is None:
+        return None
+    if width is None:
+        if max_side is None or max(img_height, img_width) <= max_side:
+            return None
+        width = max(int(img_width * max_side / max(img_height, img_width)), 1)
+    if width >= img_width:
+        return None
+    return thumbnail_size(img_size, width)
+
+
+# peak bytes of a render per output pixel: compositor and index buffers, alpha, result, BGRA copy
+# and encoder buffers, and per decoded source image pixel: the decoded image and its resized copy
+RENDER_BYTES_PER_PIXEL = 24
+SOURCE_BYTES_PER_PIXEL = 6
+
+
+def estimate_render_bytes(out_size, source_size=None) -> int:
+    """Rough peak memory of a render at out_size (height, width). source_size is the size the image
+    is decoded at for renders over the image, None for renders of the annotation only."""
+    estimate = out_size[0] * out_size[1] * RENDER_BYTES_PER_PIXEL
+    if source_size is not None:
+        estimate += source_size[0] * source_size[1] * SOURCE_BYTES_PER_PIXEL
+    return estimate
+
+
+def thumbnail_size(img_size, width: int):
+    """(height, width) of the get_rgba_np thumbnail of an image of img_size, square if unknown.
+    Neither side is less than a pixel, whatever the aspect ratio."""
+    if img_size[0] is None or img_size[1] is None:
+        return width, width
+    return max(int((img_size[0] / img_size[1]) * width), 1), width
+
+
+def admit(cost: int):
+    """Waits until a render of estimated peak memory `cost` fits into the memory budget of its
+    lane, use as `async with admit(cost):`. Raises 503 if the server is too busy."""
+    if cost <= g.FAST_LANE_MAX_RENDER_MB * 1024 * 1024:
+        return g.fast_lane.admit(cost)
+    return g.memory_budget.admit(cost)
+
+
+def jpeg_size(content: bytes):
+    """(height, width) from the frame header of a JPEG, None for other formats."""
+    if not content.startswith(b"\xff\xd8"):
+        return None
+    pos = 2
+    while pos + 4 <= len(content):
+        if content[pos] != 0xFF:
+            return None
+        marker = content[pos + 1]
+        if marker == 0xFF:  # fill byte
+            pos += 1
+            continue
+        if marker in (0x01, *range(0xD0, 0xD8)):  # markers without a length
+            pos += 2
+            continue
+        length = int.from_bytes(content[pos + 2 : pos + 4], "big")
+        # start of frame markers, except DHT (C4), JPG (C8) and DAC (CC)
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            if pos + 9 > len(content):
+                return None
+            height = int.from_bytes(content[pos + 5 : pos + 7], "big")
+            width = int.from_bytes(content[pos + 7 : pos + 9], "big")
+            return height, width
+        pos += 2 + length
+    return None
+
+
+def decode_reduced(content: bytes, out_size) -> np.ndarray:
+    """Decode image bytes into an RGB array of out_size. JPEGs are decoded at 1/8, 1/4 or 1/2 scale
+    right away, the smallest one that is still at least out_size by the size in the JPEG header."""
+    height, width = out_size
+    buffer = np.frombuffer(content, dtype=np.uint8)
+    img = None
+    size = jpeg_size(content)
+    if size is not None:
+        for factor, flag in (
+            (8, cv2.IMREAD_REDUCED_COLOR_8),
+            (4, cv2.IMREAD_REDUCED_COLOR_4),
+            (2, cv2.IMREAD_REDUCED_COLOR_2),
+        ):
+            # libjpeg rounds scaled dimensions up
+            if math.ceil(size[0] / factor) >= height and math.ceil(size[1] / factor) >= width:
+                img = cv2.imdecode(buffer, flag)
+                break
+        if img is not None and (img.shape[0] < height or img.shape[1] < width):
+            # rotated by its EXIF orientation
+            img = None
+    if img is None:
+        img = cv2.imdecode(buffer, cv2.IMREAD_COLOR)
+    img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+    if img.shape[:2] != (height, width):
+        img = cv2.resize(img, (width, height), interpolation=cv2.INTER_AREA)
+    return img
+
+
+def download_np_resized(image_info: ImageInfo, out_size=None) -> np.ndarray:
+    """Source image for rendering at out_size: a server-side resized preview if the instance can
+    produce it, otherwise the original decoded at reduced scale. None means full resolution."""
+    if out_size is None:
+        return g.api.image.download_np(image_info.id)
+    height, width = out_size
+    if image_info.full_storage_url:
+        url = g.api.image.preview_url(
+            image_info.full_storage_url, width=width, height=height, quality=90, method="force"
+        )
+        try:
+            response = requests.get(url, headers=g.api.headers, timeout=60)
+            response.raise_for_status()
+            return decode_reduced(response.content, out_size)
+        except Exception as e:
+            sly.logger.debug(f"Failed to download a preview of image {image_info.id}: {repr(e)}")
+    content = g.api.image.download_bytes(image_info.dataset_id, [image_info.id])[0]
+    return decode_reduced(content, out_size)
+
+
+def zip_renders(renders: list, errors: dict = None, ext: str = ".png") -> bytes:
+    buffer = io.BytesIO()
+    # PNGs are already compressed, deflating them again only burns CPU
+    with zipfile.ZipFile(buffer, "w", compression=zipfile.ZIP_STORED) as archive:
+        for image_id, content in renders:
+            archive.writestr(f"{image_id}{ext}", content)
+        if errors:
+            archive.writestr("errors.json", json.dumps(errors, indent=4))
+    return buffer.getvalue()
+
+
+def _nearest_indices(size_in: int, size_out: int) -> np.ndarray:
+    # same pixel centers as nearest neighbour skimage.transform.resize used by Bitmap.resize
+    indices = ((np.arange(size_out) + 0.5) * (size_in / size_out)).astype(np.int64)
+    return np.minimum(indices, size_in - 1)
+
+
+def resize_label(label: sly.Label, in_size, out_size) -> sly.Label:
+    """Label.resize that samples raster geometries straight at the output scale, only within their
+    own bounds, instead of resizing the full resolution data through float64 skimage buffers."""
+    geometry = label.geometry
+    if not isinstance(geometry, (sly.Bitmap, sly.AlphaMask)):
+        return label.resize(in_size, out_size)
+
+    row_scale = out_size[0] / in_size[0]
+    col_scale = out_size[1] / in_size[1]
+    data = geometry.data
+    scaled_rows = max(round(data.shape[0] * row_scale), 1)
+    scaled_cols = max(round(data.shape[1] * col_scale), 1)
+    scaled_origin = sly.PointLocation(
+        row=round(geometry.origin.row * row_scale), col=round(geometry.origin.col * col_scale)
+    )
+    rows = _nearest_indices(data.shape[0], scaled_rows)
+    cols = _nearest_indices(data.shape[1], scaled_cols)
+    scaled_data = data[np.ix_(rows, cols)]
+    return label.clone(geometry=geometry.__class__(data=scaled_data, origin=scaled_origin))
+
+
+def _raster_data(geometry: sly.Bitmap) -> np.ndarray:
+    # Bitmap.data returns a copy of the whole mask, this is only read
+    return geometry._data
+
+
+def sample_raster(label: sly.Label, in_size, out_size, window):
+    """The part of a bitmap or alpha mask label resized from in_size to out_size, as resize_label
+    would, that falls into window (top, left, height, width) of out_size, sampled from the source
+    data without resizing the rest. Returns the label and the sampled source rows and cols of the
+    whole resized raster with the position of the first one in out_size, or None if nothing of it is
+    in the window."""
+    geometry = label.geometry
+    top, left, height, width = window
+    sampled = []
+    for size, size_in, size_out, start, length in (
+        (_raster_data(geometry).shape[0], in_size[0], out_size[0], top, height),
+        (_raster_data(geometry).shape[1], in_size[1], out_size[1], left, width),
+    ):
+        scale = size_out / size_in
+        origin = round((geometry.origin.row if len(sampled) == 0 else geometry.origin.col) * scale)
+        indices = _nearest_indices(size, max(round(size * scale), 1))
+        first, last = max(origin, start), min(origin + len(indices), start + length)
+        if first >= last:
+            return None
+        sampled.append((indices, origin, first, last))
+    (rows, row0, top, bottom), (cols, col0, left, right) = sampled
+    data = _raster_data(geometry)[np.ix_(rows[top - row0 : bottom - row0], cols[left - col0 : right - col0])]
+    try:
+        cropped = geometry.__class__(data=data, origin=sly.PointLocation(row=top, col=left))
+    except ValueError:  # nothing set in the window
+        return None
+    return label.clone(geometry=cropped), (rows, row0), (cols, col0)
+
+
+def heatmap_range(geometry: sly.AlphaMask, rows, cols, frame_size, threshold: float):
+    """(min, max) alpha of a heatmap resized with the sampled source `rows` and `cols` (indices,
+    position in the frame) after the threshold, over the part in the frame: color_map_roi of the
+    whole resized mask in the whole frame normalizes its colors by them. Computed by bands of rows,
+    the resized mask is never allocated whole."""
+    threshold = int(255 * (threshold or 0.2))
+    (row_indices, row0), (col_indices, col0) = rows, cols
+    row_first, row_last = max(row0, 0), min(row0 + len(row_indices), frame_size[0])
+    col_first, col_last = max(col0, 0), min(col0 + len(col_indices), frame_size[1])
+    row_indices = row_indices[row_first - row0 : row_last - row0]
+    col_indices = col_indices[col_first - col0 : col_last - col0]
+    if len(row_indices) == 0 or len(col_indices) == 0:
+        return 0, 0
+    min_val, max_val = 255, 0
+    band = max((1 << 18) // len(col_indices), 1)
+    for start in range(0, len(row_indices), band):
+        values = _raster_data(geometry)[np.ix_(row_indices[start : start + band], col_indices)]
+        min_val, max_val = min(min_val, int(values.min())), max(max_val, int(values.max()))
+    covers_frame = (row_last - row_first, col_last - col_first) == tuple(frame_size[:2])
+    if min_val < threshold or not covers_frame:
+        min_val = 0
+    if max_val < threshold:
+        max_val = 0
+    return min_val, max_val
+
+
+def resize_annotation(ann: sly.Annotation, out_size) -> sly.Annotation:
+    def _resize_label(label):
+        try:
+            return [resize_label(label, ann.img_size, out_size)]
+        except ValueError:  # empty mask after resizing
+            return []
+
+    return ann.transform_labels(_resize_label, out_size)
+
+
+# JET colormap with the background color (128, 0, 0) removed channel-wise, indexed by normalized value
+_JET_LUT = cv2.applyColorMap(np.arange(256, dtype=np.uint8).reshape(256, 1), cv2.COLORMAP_JET).reshape(256, 3)
+_JET_LUT = np.where(_JET_LUT == np.array([128, 0, 0], dtype=np.uint8), 0, _JET_LUT).astype(np.uint8)
+
+
+def _clip_raster(data: np.ndarray, origin: sly.PointLocation, top, left, height, width):
     x, y = origin.col, origin.row
     h, w = data.shape[:2]
+    rows = slice(max(y, top), min(y + h, top + height))
+    cols = slice(max(x, left), min(x + w, left + width))
+    rows, cols = slice(rows.start, max(rows.stop, rows.start)), slice(cols.start, max(cols.stop, cols.start))
+    return rows, cols, data[rows.start - y : rows.stop - y, cols.start - x : cols.stop - x]
+
+
+def color_map_roi(
+    img_size, data: np.ndarray, origin: sly.PointLocation, threshold: float, value_range=None
+):
+    """Colored heatmap of an alpha mask computed only inside its bounds. Returns the (rows, cols)
+    slices of the ROI in the image and the BGR ROI itself, everything outside of it is black.
+    Colors are normalized by the min and max alpha of the ROI, or by `value_range` when the mask is
+    a part of a larger one (see heatmap_range)."""
+    rows, cols, roi = _clip_raster(data, origin, 0, 0, img_size[0], img_size[1])
+    roi = roi.astype(np.uint8)
+    if roi.size == 0:
+        return rows, cols, np.zeros((*roi.shape[:2], 3), dtype=np.uint8)
+
     threshold = threshold or 0.2
     threshold = int(255 * threshold)
-    mask[y : y + h, x : x + w] = data
-    mask[mask < threshold] = 0
-    cv2.normalize(mask, mask, 0, 255, cv2.NORM_MINMAX)
-    mask = cv2.applyColorMap(mask, cv2.COLORMAP_JET)
-    BG_COLOR = np.array([128, 0, 0], dtype=np.uint8)
-    mask = np.where(mask == BG_COLOR, 0, mask)
+    roi[roi < threshold] = 0
+
+    if value_range is None:
+        # min/max normalization over the whole image, pixels outside the ROI are zeros
+        min_val, max_val, _, _ = cv2.minMaxLoc(roi)
+        if roi.shape[:2] != tuple(img_size[:2]):
+            min_val = 0
+    else:
+        min_val, max_val = value_range
+    min_val, max_val = int(min_val), int(max_val)
+    values = np.arange(min_val, max_val + 1, dtype=np.uint8).reshape(1, -1)
+    lut = np.zeros(256, dtype=np.uint8)
+    lut[min_val : max_val + 1] = cv2.normalize(values, None, 0, 255, cv2.NORM_MINMAX).ravel()
+    return rows, cols, _JET_LUT[cv2.LUT(roi, lut)]
+
+
+def color_map(img_size, data: np.ndarray, origin: sly.PointLocation, threshold: float) -> np.ndarray:
+    mask = np.zeros((img_size[0], img_size[1], 3), dtype=np.uint8)
+    rows, cols, roi = color_map_roi(img_size, data, origin, threshold)
+    mask[rows, cols] = roi
     return mask
 
 
@@ -130,115 +774,91 @@ def get_rgba_np(
     skip_resize=False,
     render_heatmap=False,
     heatmap_threshold=None,
+    reference_size=None,
+    heatmap_ranges: dict = None,
 ) -> np.ndarray:
+    stopwatch = metrics.Stopwatch()
     try:
         if skip_resize:
             out_size = ann.img_size
         else:
-            out_size = (int((ann.img_size[0] / ann.img_size[1]) * OUTPUT_WIDTH_PX), OUTPUT_WIDTH_PX)
-            ann = ann.resize(out_size, skip_empty_masks=True)
+            out_size = thumbnail_size(ann.img_size, OUTPUT_WIDTH_PX)
+            ann = resize_annotation(ann, out_size)
+            stopwatch.lap("resize")
 
-        render_mask, render_bbox, render_fillbbox = (
-            np.zeros((ann.img_size[0], ann.img_size[1], 3), dtype=np.uint8),
-            np.zeros((ann.img_size[0], ann.img_size[1], 3), dtype=np.uint8),
-            np.zeros((ann.img_size[0], ann.img_size[1], 3), dtype=np.uint8),
-        )
+        compositor = Compositor(ann.img_size[0], ann.img_size[1])
+        thickness_size = reference_size or ann.img_size
 
-        alpha_masks = []
+        mask_labels, bbox_labels, alpha_masks = [], [], []
         for label in ann.labels:
             label: sly.Label
-            if type(label.geometry) == sly.Point:
-                label.draw(
-                    render_mask,
-                    thickness=get_thickness(render_mask, thickness_percent=3, from_min=True),
-                )
-            elif type(label.geometry) in (sly.GraphNodes, sly.Polyline):
-                label.draw(
-                    render_mask,
-                    thickness=get_thickness(render_mask, thickness_percent=2, from_min=True),
-                )
-            elif type(label.geometry) in (sly.Cuboid2d,):
-                label.draw(
-                    render_mask,
-                    thickness=get_thickness(render_mask, thickness_percent=1, from_min=True),
-                )
-            elif type(label.geometry) in (sly.Rectangle, sly.OrientedBBox):
-                thickness = get_thickness(render_bbox, BBOX_THICKNESS_PERCENT)
-                label.draw_contour(
-                    render_bbox,
-                    thickness=thickness,
-                    # draw_tags=draw_tags, #TODO fix (0,0,0,255) color font
-                    # draw_class_name=draw_class_names,
-                )
-                label.draw(render_fillbbox)
+            if type(label.geometry) in (sly.Rectangle, sly.OrientedBBox):
+                bbox_labels.append(label)
             elif type(label.geometry) == sly.AlphaMask:
                 if render_heatmap:
                     alpha_masks.append(label)
             else:
-                label.draw(
-                    render_mask,
-                    # draw_tags=draw_tags,
-                    # draw_class_name=draw_class_names,
-                )
+                mask_labels.append(label)
+
+        # layers are folded from the lowest priority to the highest: fillbbox, mask, bbox
+        render_fillbbox = compositor.new_layer()
+        rasterizer.draw_labels(render_fillbbox, bbox_labels)
+        stopwatch.lap("draw")
+        compositor.fold_layer(FILLBBOX_OPACITY)
+        stopwatch.lap("composite")
+
+        render_mask = compositor.new_layer()
+        line_thickness = get_thickness(thickness_size, thickness_percent=2, from_min=True)
+        mask_thickness = {
+            sly.Point: get_thickness(thickness_size, thickness_percent=3, from_min=True),
+            sly.GraphNodes: line_thickness,
+            sly.Polyline: line_thickness,
+            sly.Cuboid2d: get_thickness(thickness_size, thickness_percent=1, from_min=True),
+        }
+        rasterizer.draw_labels(render_mask, mask_labels, mask_thickness)
+        stopwatch.lap("draw")
         if len(alpha_masks) > 0:
             temp_mask = render_mask.copy()
             for label in alpha_masks:
-                temp = color_map(ann.img_size, label.geometry.data, label.geometry.origin, heatmap_threshold)
-                temp_mask = np.where(np.any(temp > 0, axis=-1, keepdims=True), temp, temp_mask)
-                # render_mask = np.where(np.any(temp > 0, axis=-1, keepdims=True), temp, render_mask)
-            # render_mask = cv2.addWeighted(render_mask, 0.5, temp_mask, 0.5, 0)
+                rows, cols, temp = color_map_roi(
+                    ann.img_size,
+                    label.geometry.data,
+                    label.geometry.origin,
+                    heatmap_threshold,
+                    (heatmap_ranges or {}).get(id(label)),
+                )
+                np.copyto(temp_mask[rows, cols], temp, where=np.any(temp > 0, axis=-1, keepdims=True))
             temp_mask = cv2.cvtColor(temp_mask, cv2.COLOR_BGR2RGB)
-            render_mask = np.where(np.any(temp_mask > 0, axis=-1, keepdims=True), temp_mask, render_mask)
-
-            
-        
-
-        alpha_mask = (
-            MASK_OPACITY - np.all(render_mask == [0, 0, 0], axis=-1).astype("uint8")
-        ) * 255
-        alpha_mask[alpha_mask < 0] = 0
-
-        alpha_bbox = (
-            BBOX_OPACITY - np.all(render_bbox == [0, 0, 0], axis=-1).astype("uint8")
-        ) * 255
-        alpha_bbox[alpha_bbox < 0] = 0
-
-        alpha_fillbbox = (
-            FILLBBOX_OPACITY - np.all(render_fillbbox == [0, 0, 0], axis=-1).astype("uint8")
-        ) * 255
-        alpha_fillbbox[alpha_fillbbox < 0] = 0
-
-        alpha = np.where(alpha_mask != 0, alpha_mask, alpha_fillbbox)
-        alpha = np.where(alpha_bbox != 0, alpha_bbox, alpha)
-
-        rgb = np.where(render_mask != 0, render_mask, render_fillbbox)
-        rgb = np.where(render_bbox != 0, render_bbox, rgb)
-
-        rgba = np.dstack((rgb, alpha))
+            np.copyto(render_mask, temp_mask, where=np.any(temp_mask > 0, axis=-1, keepdims=True))
+            stopwatch.lap("heatmap")
+        compositor.fold_layer(MASK_OPACITY)
+        stopwatch.lap("composite")
+
+        render_bbox = compositor.new_layer()
+        rasterizer.draw_labels(
+            render_bbox,
+            bbox_labels,
+            default_thickness=get_thickness(thickness_size, BBOX_THICKNESS_PERCENT),
+            contour=True,
+        )
+        stopwatch.lap("draw")
+        compositor.fold_layer(BBOX_OPACITY)
 
-        result = np.zeros_like(rgb, dtype=np.uint8)
+        alpha = compositor.alpha()
         if with_image is not None:
-            if bitmap is not None:
-                alpha_ = rgba[:, :, 3] / 255.0
-                alpha_inv = 1.0 - alpha_
-                # result = np.zeros_like(bitmap, dtype=np.uint8)
-                for i in range(3):  # Loop over RGB channels
-                    result[:, :, i] = (alpha_ * rgba[:, :, i] + alpha_inv * bitmap[:, :, i]).astype(
-                        np.uint8
-                    )
-            else:
-                alpha_ = rgba[:, :, 3] / 255.0
-                for i in range(3):
-                    result[:, :, i] = (alpha_ * rgba[:, :, i]).astype(np.uint8)
-
+            result = compositor.blend(bitmap)
+            stopwatch.lap("composite")
             for label in ann.labels:
                 font = label._get_font(result.shape[:2])
                 if draw_tags:
                     label._draw_tags(result, font, add_class_name=draw_class_names)
                 elif draw_class_names:
                     label._draw_class_name(result, font)
+            stopwatch.lap("text")
         else:
-            result = rgba
+            result = compositor.finish()
+            stopwatch.lap("composite")
+        stopwatch.stop()
 
     except Exception as e:
         new_error_message = f"PROJECT ID: {project_id}, IMAGE ID: {image_id}. Error: {e}"
@@ -247,43 +867,6 @@ def get_rgba_np(
     return result, alpha, out_size
 
 
-def handle_broken_annotations(jann, json_project_meta):
-    ann_ids = [obj["classId"] for obj in jann["objects"]]
-    class_dict = {cls["id"]: cls for cls in json_project_meta["classes"]}
-    filtered_cls = [class_dict[ann_id] for ann_id in ann_ids if ann_id in class_dict]
-
-    sorted_ann = sorted(jann["objects"], key=lambda x: x["classId"])
-    sorted_cls = sorted(filtered_cls, key=lambda x: x["id"])
-
-    def _conditions(_ann, _cls):
-        if (
-            _ann["geometryType"] == Bitmap.geometry_name()
-            and _cls["shape"] == Rectangle.geometry_name()
-        ):
-            return True
-        if _ann["geometryType"] == Cuboid.geometry_name():
-            return True
-        if _ann["geometryType"] == Polygon.geometry_name() and len(_ann["points"]["exterior"]) < 3:
-            return True
-        if (
-            _ann["geometryType"] == Rectangle.geometry_name()
-            and len(_ann["points"]["exterior"]) < 2
-        ):
-            return True
-        if _ann["geometryType"] == Bitmap.geometry_name() and not np.any(
-            Bitmap.base64_2_data(_ann["bitmap"]["data"])
-        ):
-            return True
-        return False
-
-    cls_to_drop = [
-        _ann["classId"]
-        for _ann, _cls in zip(sorted_ann, sorted_cls)
-        if _conditions(_ann, _cls) is True
-    ]
-    return [obj for obj in jann["objects"] if obj["classId"] not in cls_to_drop]
-
-
 def handle_broken_project_meta(json_project_meta: dict) -> dict:
     for idx, cls in enumerate(json_project_meta["classes"]):
         if _validate_hex_color(cls["color"]) is False:
@@ -319,21 +902,3 @@ def handle_broken_project_meta(json_project_meta: dict) -> dict:
                         )
 
     return json_project_meta
-
-
-def image_was_updated(project: ProjectInfo, image: ImageInfo) -> bool:
-
-    cache_dir = f"{g.STORAGE_DIR}/cached_updated_at/{project.id}"
-    os.makedirs(cache_dir, exist_ok=True)
-    image_path = f"{cache_dir}/{image.id}.txt"
-
-    if sly.fs.file_exists(image_path):
-        with open(image_path, "r") as file:
-            cached_updated_at = file.read()
-        if cached_updated_at != image.updated_at:
-            return True
-
-    with open(image_path, "w") as file:
-        file.write(image.updated_at)
-
-    return False
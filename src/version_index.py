@@ -0,0 +1,129 @@
+import atexit
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+import supervisely as sly
+from src.shared_cache import SharedCache
+
+
+class VersionIndex:
+    """Image `updated_at` values in one SQLite database (WAL mode) instead of a text file per image.
+
+    Recently used keys are served from an in-memory LRU without touching the disk. Writes are buffered
+    and flushed in one transaction when the buffer is full, when `flush_interval` seconds have passed
+    since the last flush, or at exit. Flushed versions are also written to the `shared` cache of all
+    replicas, where images unknown locally are looked up.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        hot_size: int = 100_000,
+        batch_size: int = 500,
+        flush_interval: float = 2.0,
+        shared: Optional[SharedCache] = None,
+    ):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.hot_size = hot_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.shared = shared
+        self._lock = threading.Lock()
+        self._hot = OrderedDict()  # image_id -> updated_at
+        self._pending = {}  # image_id -> (project_id, updated_at)
+        self._last_flush = time.monotonic()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS images ("
+            "image_id INTEGER PRIMARY KEY, project_id INTEGER, updated_at TEXT NOT NULL)"
+        )
+        atexit.register(self.flush)
+
+    def get(self, image_id: int) -> Optional[str]:
+        with self._lock:
+            updated_at = self._hot.get(image_id)
+            if updated_at is not None:
+                self._hot.move_to_end(image_id)
+                return updated_at
+            pending = self._pending.get(image_id)
+            if pending is not None:
+                return pending[1]
+            row = self._conn.execute(
+                "SELECT updated_at FROM images WHERE image_id = ?", (image_id,)
+            ).fetchone()
+            if row is not None:
+                self._remember(image_id, row[0])
+                return row[0]
+        if self.shared is None:
+            return None
+        data = self.shared.get(f"version:{image_id}")
+        if data is None:
+            return None
+        updated_at = data.decode("utf-8")
+        with self._lock:
+            self._remember(image_id, updated_at)
+        return updated_at
+
+    def set(self, image_id: int, updated_at: str, project_id: Optional[int] = None):
+        flushed = []
+        with self._lock:
+            self._remember(image_id, updated_at)
+            self._pending[image_id] = (project_id, updated_at)
+            if (
+                len(self._pending) >= self.batch_size
+                or time.monotonic() - self._last_flush >= self.flush_interval
+            ):
+                flushed = self._flush()
+        self._share(flushed)
+
+    def flush(self):
+        with self._lock:
+            flushed = self._flush()
+        self._share(flushed)
+
+    def _flush(self) -> list:
+        # returns the flushed rows, share them after releasing the lock: it is a network round trip
+        self._last_flush = time.monotonic()
+        if len(self._pending) == 0:
+            return []
+        rows = [(image_id, *value) for image_id, value in self._pending.items()]
+        self._pending = {}
+        try:
+            self._write(rows)
+        except sqlite3.Error as e:
+            sly.logger.warning(f"Failed to write {len(rows)} image versions to the index: {e}")
+        return rows
+
+    def _share(self, rows: list):
+        if self.shared is not None and len(rows) > 0:
+            self.shared.put_many(
+                (f"version:{image_id}", updated_at.encode("utf-8")) for image_id, _, updated_at in rows
+            )
+
+    def _write(self, rows: list):
+        self._conn.execute("BEGIN")
+        try:
+            self._conn.executemany(
+                "INSERT INTO images (image_id, project_id, updated_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(image_id) DO UPDATE SET "
+                "project_id = COALESCE(excluded.project_id, images.project_id), "
+                "updated_at = excluded.updated_at",
+                rows,
+            )
+            self._conn.execute("COMMIT")
+        except Exception:
+            self._conn.execute("ROLLBACK")
+            raise
+
+    def _remember(self, image_id: int, updated_at: str):
+        self._hot[image_id] = updated_at
+        self._hot.move_to_end(image_id)
+        while len(self._hot) > self.hot_size:
+            self._hot.popitem(last=False)
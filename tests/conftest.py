@@ -0,0 +1,14 @@
+import os
+import sys
+import tempfile
+
+# the render modules create an API client and read the app environment on import, the tests do
+# not request anything from an instance
+os.environ.setdefault("SERVER_ADDRESS", "http://localhost")
+os.environ.setdefault("API_TOKEN", "0" * 128)
+os.environ.setdefault("TEAM_ID", "1")
+os.environ.setdefault("WORKSPACE_ID", "1")
+os.environ.setdefault("SLY_APP_DATA_DIR", os.path.join(tempfile.gettempdir(), "render-tests"))
+os.environ.setdefault("ENV", "development")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
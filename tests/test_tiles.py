@@ -0,0 +1,97 @@
+import math
+import tracemalloc
+
+import cv2
+import numpy as np
+import pytest
+
+import src.utils as u
+import supervisely as sly
+from benchmarks.synthetic import KINDS, make_annotation
+
+HEIGHT, WIDTH = 300, 420
+TILE = 128
+SETTINGS = {"RENDER_HEATMAPS": True, "HEATMAP_THRESHOLD": 0.2, "BBOX_THICKNESS_PERCENT": 0.5}
+# OpenCV rasterizes lines and polygon edges clipped at the canvas border from the clipped end points
+# and rotated boxes have float corners, so edges crossing a seam may be a pixel off along their
+# length. Everything else must be the same.
+EXACT = ("rectangle", "bitmap", "alpha_mask", "point")
+MAX_DIFFERENT = 0.03
+
+
+def _full_render(ann, zoom: int) -> np.ndarray:
+    scale = 2**zoom
+    frame_size = (math.ceil(HEIGHT / scale), math.ceil(WIDTH / scale))
+    if zoom > 0:
+        ann = u.resize_annotation(ann, frame_size)
+    rgba, _, _ = u.get_rgba_np(
+        ann,
+        frame_size[1],
+        SETTINGS["BBOX_THICKNESS_PERCENT"],
+        1,
+        0.2,
+        0.7,
+        0,
+        0,
+        skip_resize=True,
+        render_heatmap=True,
+        heatmap_threshold=SETTINGS["HEATMAP_THRESHOLD"],
+        reference_size=(HEIGHT / scale, WIDTH / scale),
+    )
+    return rgba.astype(np.uint8)
+
+
+def _stitched_tiles(ann, zoom: int) -> np.ndarray:
+    rows = []
+    for top in range(0, HEIGHT, TILE):
+        row = []
+        for left in range(0, WIDTH, TILE):
+            height, width = min(TILE, HEIGHT - top), min(TILE, WIDTH - left)
+            content = u.get_rendered_tile(
+                0, 0, None, top, left, height, width, zoom, settings=SETTINGS, ann=ann
+            )
+            bgra = cv2.imdecode(np.frombuffer(content, np.uint8), cv2.IMREAD_UNCHANGED)
+            row.append(cv2.cvtColor(bgra, cv2.COLOR_BGRA2RGBA))
+        rows.append(np.concatenate(row, axis=1))
+    return np.concatenate(rows, axis=0)
+
+
+@pytest.mark.parametrize("zoom", [0, 1])
+@pytest.mark.parametrize("kind", KINDS)
+def test_stitched_tiles_match_full_render(kind, zoom):
+    # large labels, most of them cross the tile seams
+    ann, _ = make_annotation(HEIGHT, WIDTH, 12, kinds=(kind,), label_size=160, seed=7)
+    full = _full_render(ann, zoom)
+    tiles = _stitched_tiles(ann, zoom)
+    assert tiles.shape == full.shape
+    different = np.count_nonzero(np.any(tiles != full, axis=-1))
+    if kind in EXACT:
+        assert different == 0
+    else:
+        assert different <= MAX_DIFFERENT * full.shape[0] * full.shape[1]
+
+
+@pytest.mark.parametrize("zoom", [1, 3])
+def test_tile_of_full_frame_rasters_allocates_tile_sized_buffers(zoom):
+    size = 4096
+    mask = sly.ObjClass("mask", sly.Bitmap, color=[255, 0, 0])
+    heatmap = sly.ObjClass("heatmap", sly.AlphaMask, color=[0, 255, 0])
+    alpha = np.random.default_rng(0).integers(1, 256, (size, size), dtype=np.uint8)
+    ann = u.uncropped_annotation(
+        (size, size),
+        [
+            sly.Label(sly.Bitmap(np.ones((size, size), dtype=bool)), mask),
+            sly.Label(sly.AlphaMask(alpha), heatmap),
+        ],
+    )
+    scale = 2**zoom
+    tracemalloc.start()
+    try:
+        u.get_rendered_tile(
+            0, 0, None, 1000, 1000, TILE * scale, TILE * scale, zoom, settings=SETTINGS, ann=ann
+        )
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    # a raster resized to the whole zoomed frame alone would take (4096 / 2^zoom)^2 bytes
+    assert peak < 2 * 1024 * 1024